@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+
+__doc__ = """
+extract.py 的性能测试
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import zipfile
+import argparse
+import tempfile
+import platform
+import threading
+import subprocess
+
+import extract
+
+
+# 原来逐个关键字扫描的实现，作为结果和性能的参照
+def legacy_is_payment(fname):
+    base_name = os.path.splitext(fname)[0].lower()
+    ext = os.path.splitext(fname)[-1].lower()
+    exclude_keys = extract.paper_keys + extract.report_keys + extract.copyright_keys + extract.other_keys
+    if ext in ['.png', '.jpg', '.jpeg']:
+        return True
+    for key in exclude_keys:
+        if key in base_name:
+            return False
+    for key in extract.payment_keys:
+        if key in base_name:
+            return True
+    return False
+
+def legacy_is_camera(fname):
+    return legacy_is_paper(fname, valid_exts=['.docx', '.doc'], invalid_exts=['.pdf', '.png', '.jpg', '.jpeg'])
+
+def legacy_is_paper(fname, valid_exts=['.docx', '.doc', '.pdf'], invalid_exts=['.png', '.jpeg', 'jpg']):
+    base_name = os.path.splitext(fname)[0].lower()
+    ext = os.path.splitext(fname)[-1].lower()
+    exclude_keys = extract.other_keys + extract.payment_keys + extract.report_keys
+    for key in exclude_keys:
+        if key in base_name:
+            return False
+    for key in extract.paper_keys:
+        if key in base_name and ext not in invalid_exts:
+            return True
+    if ext in valid_exts:
+        return True
+    return False
+
+def legacy_is_copyright(fname):
+    stem_name = os.path.splitext(fname)[0].lower()
+    return any(key in stem_name for key in extract.copyright_keys)
+
+
+name_words = ['Final', 'version', 'ICCWAMTIP', '2020', 'Zhang San', 'Li_Si', '终稿', '修改稿',
+              'feedback', 'Fees', 'Payment', '付款凭证', 'Camera Ready', 'PAPER', '论文',
+              'Plagiarism Report', '查重报告', 'Copyright Form', 'receipt', '转账截图', 'scan']
+name_exts = ['.docx', '.doc', '.pdf', '.png', '.jpg', '.jpeg', '.JPG', '.zip', '.txt', '']
+
+
+def random_name(rnd):
+    words = rnd.sample(name_words, rnd.randint(1, 4))
+    return rnd.choice(['-', '_', ' ', '']).join(words) + rnd.choice(name_exts)
+
+
+def synthetic_paths(count, seed=0):
+    """生成 count 个 CMT 风格的压缩包内文件路径"""
+    rnd = random.Random(seed)
+    paths = []
+    for _ in range(count):
+        folder = rnd.choice(['Submission', 'CameraReady', 'CameraReady/Supplementary'])
+        paths.append("{}/{}/{}".format(rnd.randint(1, 3000), folder, random_name(rnd)))
+    return paths
+
+
+# 生成的压缩包内文件名使用的关键字
+archive_words = {
+    'paper': ['Paper', 'paper', '论文', 'Manuscript', 'Camera Ready', 'final', 'ICCWAMTIP'],
+    'payment': ['Payment', '付款凭证', '缴费', 'Fee', 'receipt', '转账截图'],
+    'report': ['Plagiarism Report', '查重报告', 'report'],
+    'copyright': ['Copyright Form', 'copyright'],
+}
+
+
+def generate_archive(path, ids=200, files=3, min_size=16*1024, max_size=512*1024,
+                     camera_ratio=0.5, zh_ratio=0.3, image_ratio=0.2, seed=0):
+    """
+    生成 CMT 格式的测试压缩包
+    <id>/Submission/<files> 和 <id>/CameraReady/<files>
+    :param ids:          论文数量
+    :param files:        每篇论文 Submission 下的文件数量
+    :param min_size:     文件最小字节数
+    :param max_size:     文件最大字节数
+    :param camera_ratio: 有 CameraReady 文件的论文比例
+    :param zh_ratio:     使用中文文件名的比例
+    :param image_ratio:  图片（缴费截图等）的比例
+    :return:             压缩包内文件总字节数
+    """
+
+    rnd = random.Random(seed)
+    total = 0
+
+    def content(ext):
+        size = rnd.randint(min_size, max_size)
+        # 文档大部分可以压缩，图片和 pdf 基本不能压缩
+        if ext in ('.doc', '.txt'):
+            words = b' '.join(rnd.choice([b'wavelet', b'media', b'signal', b'image', b'network'])
+                              for _ in range(64))
+            return (words * (size // len(words) + 1))[:size]
+        return os.urandom(size)
+
+    def name(category, ext):
+        words = [w for w in archive_words[category] if (ord(w[0]) > 127) == (rnd.random() < zh_ratio)]
+        words = words or archive_words[category]
+        return "{}-{}{}".format(rnd.choice(words), rnd.randint(1, 99), ext)
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for id_ in range(1, ids + 1):
+            members = []
+            for _ in range(files):
+                if rnd.random() < image_ratio:
+                    members.append(('Submission', name('payment', rnd.choice(['.png', '.jpg', '.jpeg']))))
+                    continue
+                category = rnd.choice(['paper', 'paper', 'paper', 'payment', 'report', 'copyright'])
+                members.append(('Submission', name(category, rnd.choice(['.docx', '.doc', '.pdf']))))
+            if rnd.random() < camera_ratio:
+                members.append(('CameraReady', name('paper', '.docx')))
+                members.append(('CameraReady', name('copyright', '.pdf')))
+            for folder, fname in members:
+                data = content(os.path.splitext(fname)[-1])
+                zf.writestr("{}/{}/{}".format(id_, folder, fname), data)
+                total += len(data)
+    return total
+
+
+def dir_size(path):
+    total = 0
+    for dirpath, dnames, fnames in os.walk(path):
+        for fname in fnames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, fname))
+            except OSError:
+                # 文件在统计时被移动或者删除了
+                pass
+    return total
+
+
+def run_extract(args, workdir, interval=0.05):
+    """
+    在 workdir 下运行 extract.py args
+    :return: (秒数, 最大常驻内存字节数, workdir 最大占用字节数)
+    """
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'extract.py')
+    peak_disk = 0
+    done = threading.Event()
+
+    def watch_disk():
+        nonlocal peak_disk
+        while not done.is_set():
+            peak_disk = max(peak_disk, dir_size(workdir))
+            done.wait(interval)
+
+    watcher = threading.Thread(target=watch_disk)
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, script] + args, cwd=workdir,
+                            stdout=subprocess.DEVNULL)
+    watcher.start()
+    # 用 wait4 取得子进程（包括它的子进程）的最大常驻内存
+    _, status, usage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    done.set()
+    watcher.join()
+    peak_disk = max(peak_disk, dir_size(workdir))
+    if proc.returncode != 0:
+        raise RuntimeError("extract.py {} failed ({})".format(' '.join(args), proc.returncode))
+    # Linux 下 ru_maxrss 的单位是 KB，macOS 下是字节
+    maxrss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    return elapsed, maxrss, peak_disk
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def bench_run(args):
+    tmpdir = tempfile.mkdtemp(prefix='bench-extract-')
+    try:
+        source_zip = os.path.abspath(args.archive) if args.archive else os.path.join(tmpdir, 'Submission.zip')
+        if not args.archive:
+            generate_archive(source_zip, args.ids, args.files, args.min_size, args.max_size,
+                             seed=args.seed)
+        source_size = os.path.getsize(source_zip)
+        results = {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'archive': args.archive,
+            'generator': None if args.archive else {
+                'ids': args.ids, 'files': args.files, 'min_size': args.min_size,
+                'max_size': args.max_size, 'seed': args.seed,
+            },
+            'archive_bytes': source_size,
+            'cases': {},
+        }
+        print("archive {} ({:.1f} MB)".format(args.archive or 'generated', source_size / 1024**2))
+
+        for engine in args.engines:
+            for mode in args.modes:
+                best = None
+                for _ in range(args.repeat):
+                    workdir = tempfile.mkdtemp(dir=tmpdir)
+                    distance = 'out' if mode == 'all' or ',' in mode else 'out.zip'
+                    options = ['--legacy'] if engine == 'legacy' else []
+                    elapsed, maxrss, peak_disk = run_extract(options + [mode, source_zip, distance], workdir)
+                    output_size = dir_size(os.path.join(workdir, distance)) \
+                            if os.path.isdir(os.path.join(workdir, distance)) \
+                            else os.path.getsize(os.path.join(workdir, distance))
+                    shutil.rmtree(workdir)
+                    if best is None or elapsed < best['seconds']:
+                        best = {
+                            'seconds': elapsed,
+                            'mb_per_second': source_size / 1024**2 / elapsed,
+                            'peak_rss_bytes': maxrss,
+                            'peak_disk_bytes': peak_disk,
+                            'output_bytes': output_size,
+                        }
+                case = "{}:{}".format(engine, mode)
+                results['cases'][case] = best
+                print("{:20} {:8.3f}s {:8.1f} MB/s  rss {:7.1f} MB  disk {:8.1f} MB  output {:8.1f} MB".format(
+                    case, best['seconds'], best['mb_per_second'], best['peak_rss_bytes'] / 1024**2,
+                    best['peak_disk_bytes'] / 1024**2, best['output_bytes'] / 1024**2))
+        return results, True
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def bench_generate(args):
+    total = generate_archive(args.output, args.ids, args.files, args.min_size, args.max_size,
+                             seed=args.seed)
+    print("{}: {:.1f} MB of files, {:.1f} MB archive".format(
+        args.output, total / 1024**2, os.path.getsize(args.output) / 1024**2))
+    # 生成的压缩包就是结果，不需要再保存 JSON
+    args.output = None
+    return {}, True
+
+
+def bench_compare(args):
+    """对比两次 run 的结果，打印 new/old 的比值"""
+    with open(args.old) as fp:
+        old = json.load(fp)
+    with open(args.new) as fp:
+        new = json.load(fp)
+    keys = ['seconds', 'peak_rss_bytes', 'peak_disk_bytes']
+    print("{:20} {}".format('case', ''.join("{:>18}".format(key) for key in keys)))
+    ok = True
+    for case, result in new['cases'].items():
+        if case not in old['cases']:
+            continue
+        ratios = [result[key] / old['cases'][case][key] if old['cases'][case][key] else 1.0 for key in keys]
+        # 任何一项比原来差 args.threshold 以上就认为性能退化
+        regressed = any(ratio > 1 + args.threshold for ratio in ratios)
+        ok = ok and not regressed
+        print("{:20} {}{}".format(case, ''.join("{:>17.2f}x".format(ratio) for ratio in ratios),
+                                  '  REGRESSION' if regressed else ''))
+    if not ok:
+        print("performance regression")
+    args.output = None
+    return {}, ok
+
+
+def time_it(func, names, repeat):
+    """返回 repeat 次运行中最快一次的秒数"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for name in names:
+            func(name)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_classify(args):
+    names = [extract.split_member(path)[1] for path in synthetic_paths(args.count, args.seed)]
+    pairs = [
+        ('payment', legacy_is_payment, extract.is_payment),
+        ('paper', legacy_is_paper, extract.is_paper),
+        ('copyright', legacy_is_copyright, extract.is_copyright),
+        ('camera', legacy_is_camera, extract.is_camera),
+    ]
+    results = {'count': len(names), 'predicates': {}}
+    ok = True
+    for name, legacy, current in pairs:
+        mismatch = [fname for fname in names if legacy(fname) != current(fname)]
+        ok = ok and not mismatch
+        legacy_time = time_it(legacy, names, args.repeat)
+        current_time = time_it(current, names, args.repeat)
+        results['predicates'][name] = {
+            'legacy_seconds': legacy_time,
+            'seconds': current_time,
+            'speedup': legacy_time / current_time,
+            'mismatch': mismatch[:10],
+        }
+        print("{:10} legacy {:.3f}s  compiled {:.3f}s  x{:.2f}  mismatch {}".format(
+            name, legacy_time, current_time, legacy_time / current_time, len(mismatch)))
+
+    # 一次扫描得到所有类别，对比分别调用四个判断函数
+    legacy_all = lambda fname: [f(fname) for _, f, _ in pairs]
+    legacy_time = time_it(legacy_all, names, args.repeat)
+    current_time = time_it(extract.classifier.classify, names, args.repeat)
+    results['classify'] = {'legacy_seconds': legacy_time, 'seconds': current_time,
+                           'speedup': legacy_time / current_time}
+    print("{:10} legacy {:.3f}s  compiled {:.3f}s  x{:.2f}".format(
+        'all', legacy_time, current_time, legacy_time / current_time))
+    if not ok:
+        print("results differ from the legacy implementation")
+    return results, ok
+
+
+def args_parser():
+    parser = argparse.ArgumentParser(description='extract.py 的性能测试')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    classify = subparsers.add_parser('classify', help="文件名分类的性能测试")
+    classify.add_argument('-n', '--count', type=int, default=100000, help="文件路径数量 (默认 100000)")
+    classify.add_argument('-r', '--repeat', type=int, default=3, help="重复次数，取最快的一次 (默认 3)")
+    classify.add_argument('--seed', type=int, default=0, help="随机数种子")
+    classify.add_argument('-o', '--output', help="以 JSON 格式保存结果")
+    classify.set_defaults(func=bench_classify)
+
+    def add_archive_arguments(p):
+        p.add_argument('--ids', type=int, default=200, help="论文数量 (默认 200)")
+        p.add_argument('--files', type=int, default=3, help="每篇论文 Submission 下的文件数 (默认 3)")
+        p.add_argument('--min-size', type=extract.parse_size, default=16*1024, help="文件最小大小 (默认 16K)")
+        p.add_argument('--max-size', type=extract.parse_size, default=512*1024, help="文件最大大小 (默认 512K)")
+        p.add_argument('--seed', type=int, default=0, help="随机数种子")
+
+    generate = subparsers.add_parser('generate', help="生成 CMT 格式的测试压缩包")
+    add_archive_arguments(generate)
+    generate.add_argument('output', help="生成的压缩包路径")
+    generate.set_defaults(func=bench_generate)
+
+    run = subparsers.add_parser('run', help="运行 extract.py 的各个模式并统计时间、内存和磁盘占用")
+    add_archive_arguments(run)
+    run.add_argument('-a', '--archive', help="使用已有的压缩包，默认按照参数生成一个")
+    run.add_argument('-m', '--modes', type=lambda s: s.split(),
+                     default=['paper', 'payment', 'copyright', 'camera', 'all'],
+                     help="测试的模式，用空格分隔 (默认 'paper payment copyright camera all')")
+    run.add_argument('-e', '--engines', type=lambda s: s.split(','), default=['stream', 'legacy'],
+                     help="测试的流程: stream,legacy (默认两者都测试)")
+    run.add_argument('-r', '--repeat', type=int, default=1, help="重复次数，取最快的一次 (默认 1)")
+    run.add_argument('-o', '--output', help="以 JSON 格式保存结果")
+    run.set_defaults(func=bench_run)
+
+    compare = subparsers.add_parser('compare', help="对比两次 run 保存的 JSON 结果")
+    compare.add_argument('old', help="原来的结果")
+    compare.add_argument('new', help="新的结果")
+    compare.add_argument('-t', '--threshold', type=float, default=0.1,
+                         help="比原来差多少认为是性能退化 (默认 0.1)")
+    compare.set_defaults(func=bench_compare)
+    return parser
+
+
+def main():
+    args = args_parser().parse_args()
+    results, ok = args.func(args)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, ensure_ascii=False, indent=2)
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
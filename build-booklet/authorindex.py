@@ -0,0 +1,96 @@
+"""
+作者索引：规范化的作者名 -> 按 (论文编号, 页码) 排序的论文列表
+
+一次建立索引时先收集所有作者再排序；之后可以单独加入或者删除一篇论文的作者，
+不需要重新建立整个索引
+"""
+
+import re
+import csv
+import unicodedata
+from bisect import bisect_left, insort
+
+
+def normalize_name(name):
+    """
+    规范化作者名：全角字符转为半角（NFKC），合并空白，转为大写
+    例如 'Zhang　 san' 和 'ZHANG SAN' 都规范化为 'ZHANG SAN'
+    """
+    name = unicodedata.normalize('NFKC', name)
+    name = re.sub(r'\s*-\s*', '-', name)
+    return re.sub(r'\s+', ' ', name).strip().upper()
+
+
+class Author:
+    """索引中的一条记录"""
+
+    def __init__(self, name, track_id, page_no):
+        self.name = name
+        self.track_id = track_id    # 论文编号，如 #01_02
+        self.page_no = page_no      # 论文的起始页码
+
+
+class AuthorIndex:
+
+    def __init__(self):
+        self._names = []        # 排序的作者名
+        self._postings = {}     # 作者名: [(论文编号, 页码, 论文), ...]，已排序
+        self._papers = {}       # 论文: [(作者名, (论文编号, 页码, 论文)), ...]
+
+    @classmethod
+    def from_table(cls, table):
+        """从页码表 (PageTable) 建立索引，所有作者收集完后每个列表只排序一次"""
+        index = cls()
+        for entry in table:
+            for name, posting in index._paper_postings(entry.fname, entry.paper.author_names,
+                                                       entry.label, entry.start):
+                index._postings.setdefault(name, []).append(posting)
+        for postings in index._postings.values():
+            postings.sort()
+        index._names = sorted(index._postings)
+        return index
+
+    def _paper_postings(self, fname, names, track_id, page_no):
+        postings = [(normalize_name(name), (track_id, page_no, fname)) for name in names]
+        postings = [(name, posting) for name, posting in postings if name]
+        self._papers.setdefault(fname, []).extend(postings)
+        return postings
+
+    def add_paper(self, fname, names, track_id, page_no):
+        """加入论文 fname 的作者 names"""
+        for name, posting in self._paper_postings(fname, names, track_id, page_no):
+            if name not in self._postings:
+                insort(self._names, name)
+                self._postings[name] = []
+            insort(self._postings[name], posting)
+
+    def add_entry(self, entry):
+        """加入页码表中一篇论文 (booklet.Entry) 的作者"""
+        self.add_paper(entry.fname, entry.paper.author_names, entry.label, entry.start)
+
+    def remove_paper(self, fname):
+        """删除论文 fname 的所有作者"""
+        for name, posting in self._papers.pop(fname, []):
+            postings = self._postings[name]
+            del postings[bisect_left(postings, posting)]
+            if not postings:
+                del self._postings[name]
+                del self._names[bisect_left(self._names, name)]
+
+    def __contains__(self, name):
+        return normalize_name(name) in self._postings
+
+    def __len__(self):
+        return sum(len(postings) for postings in self._postings.values())
+
+    def __iter__(self):
+        """按照 (作者名, 论文编号, 页码) 的顺序返回 Author"""
+        for name in self._names:
+            for track_id, page_no, _ in self._postings[name]:
+                yield Author(name, track_id, page_no)
+
+    def write_csv(self, fname):
+        with open(fname, 'w', newline='', encoding='utf-8') as fp:
+            writer = csv.writer(fp)
+            writer.writerow(['name', 'track_id', 'page'])
+            writer.writerows([author.name, author.track_id, author.page_no] for author in self)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from glob import glob
+
+from docx import Document
+from docx.shared import Cm
+from docx.enum.text import WD_TAB_ALIGNMENT, WD_TAB_LEADER
+
+import paperinfo
+from booklet import load_script
+from authorindex import Author
+
+__doc__ = """
+build-booklet 中读写 docx 的性能测试
+"""
+
+
+def generate_paper(fname, no, pages=12, tables=4, rnd=random):
+    """生成一篇格式和会议论文相同的测试论文"""
+    doc = Document()
+    doc.add_paragraph("A Study of Wavelet Active Media Technology {}".format(no))
+    p = doc.add_paragraph()
+    for i, name in enumerate(["Zhang San", "Li Si", "Wang Wu"], 1):
+        p.add_run(name)
+        p.add_run(str(i)).font.superscript = True
+        if i < 3:
+            p.add_run(", ")
+    doc.add_paragraph("1 School of Computer Science and Engineering, UESTC, Chengdu 611731, China")
+    doc.add_paragraph("2 School of Information and Software Engineering, UESTC, Chengdu 610054, China")
+    doc.add_paragraph("E-mail: author{}@uestc.edu.cn".format(no))
+    doc.add_paragraph("Abstract:")
+    doc.add_paragraph("This paper studies wavelet transforms. " * 10)
+    doc.add_paragraph("Keywords:")
+    doc.add_paragraph("wavelet; media; signal processing")
+    words = ['wavelet', 'transform', 'signal', 'image', 'network', 'feature', 'model', 'result']
+    for page in range(pages):
+        doc.add_heading("Section {}".format(page + 1), 2)
+        for _ in range(8):
+            doc.add_paragraph(' '.join(rnd.choice(words) for _ in range(80)))
+        if page < tables:
+            table = doc.add_table(rows=10, cols=5)
+            for row in table.rows:
+                for cell in row.cells:
+                    cell.text = rnd.choice(words)
+        doc.add_page_break()
+    doc.save(fname)
+
+
+def bench_generate(args):
+    rnd = random.Random(args.seed)
+    os.makedirs(args.directory, exist_ok=True)
+    for no in range(1, args.count + 1):
+        generate_paper(os.path.join(args.directory, "{}.docx".format(no)), no, args.pages, args.tables, rnd)
+    print("{} papers generated in {}".format(args.count, args.directory))
+    return {}, True
+
+
+def bench_parse(args):
+    """对比流式读取和 python-docx 读取每篇论文的时间"""
+    fnames = args.papers or sorted(glob('*.docx'))
+    results = {'papers': len(fnames), 'stream_seconds': 0.0, 'docx_seconds': 0.0, 'mismatch': []}
+    for fname in fnames:
+        start = time.perf_counter()
+        fast = paperinfo.read_paper(fname, fast=True)
+        results['stream_seconds'] += time.perf_counter() - start
+        start = time.perf_counter()
+        slow = paperinfo.read_paper(fname, fast=False)
+        results['docx_seconds'] += time.perf_counter() - start
+        if fast.to_dict() != slow.to_dict():
+            results['mismatch'].append(fname)
+    count = max(len(fnames), 1)
+    print("{} papers, per paper: stream {:.2f} ms, python-docx {:.2f} ms, x{:.1f}".format(
+        len(fnames), results['stream_seconds'] / count * 1000, results['docx_seconds'] / count * 1000,
+        results['docx_seconds'] / max(results['stream_seconds'], 1e-9)))
+    for fname in results['mismatch']:
+        print("{}: results differ".format(fname))
+    return results, not results['mismatch']
+
+
+def legacy_author_index(authors, output, template):
+    """原来的 generate-autorindex.format_out：每个条目单独 add_paragraph 并设置制表位"""
+    doc = Document(template)
+    if doc.paragraphs and doc.paragraphs[-1].text == '':
+        p = doc.paragraphs[-1]._element
+        p.getparent().remove(p)
+    NAME_LEN = 19
+    index = None
+    for author in authors:
+        if author.name[0] != index:
+            index = author.name[0]
+            doc.add_heading(index, 2)
+        if len(author.name) >= NAME_LEN:
+            doc.add_paragraph(author.name)
+            p = doc.add_paragraph(f"\t{author.track_id}{' '*5}{author.page_no}")
+        else:
+            p = doc.add_paragraph(f"{author.name}\t{author.track_id}{' '*5}{author.page_no}")
+        p.paragraph_format.tab_stops.add_tab_stop(Cm(4.5), WD_TAB_ALIGNMENT.LEFT, WD_TAB_LEADER.SPACES)
+    doc.save(output)
+
+
+def synthetic_authors(count, rnd=random):
+    """count 个按照 (作者名, 论文编号) 排序的随机作者"""
+    surnames = ['ZHANG', 'WANG', 'LI', 'LIU', 'CHEN', 'YANG', 'HUANG', 'ZHAO', 'WU', 'ZHOU']
+    authors = []
+    for _ in range(count):
+        name = "{} {}".format(rnd.choice(surnames), ''.join(rnd.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+                                                          for _ in range(rnd.randint(3, 16))))
+        track, no = rnd.randint(1, 3), rnd.randint(1, 99)
+        authors.append(Author(name, f"#{track:02}_{no:02}", rnd.randint(1, 999)))
+    authors.sort(key=lambda author: (author.name, author.track_id))
+    return authors
+
+
+def bench_writer(args):
+    """对比原来逐个添加段落和 docxwriter 批量写入作者索引的时间"""
+    script = load_script('generate-autorindex')
+    authors = synthetic_authors(args.count, random.Random(args.seed))
+    template = script.default_template()
+    os.makedirs(args.directory, exist_ok=True)
+    legacy_out = os.path.join(args.directory, 'author-index-legacy.docx')
+    batch_out = os.path.join(args.directory, 'author-index.docx')
+
+    start = time.perf_counter()
+    legacy_author_index(authors, legacy_out, template)
+    legacy_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    script.format_out(authors, batch_out, template)
+    batch_seconds = time.perf_counter() - start
+
+    same = [p.text for p in Document(legacy_out).paragraphs] == [p.text for p in Document(batch_out).paragraphs]
+    results = {'entries': args.count, 'legacy_seconds': legacy_seconds, 'batch_seconds': batch_seconds,
+               'same_text': same}
+    print("{} entries: legacy {:.2f} s, batch {:.2f} s, x{:.1f}{}".format(
+        args.count, legacy_seconds, batch_seconds, legacy_seconds / max(batch_seconds, 1e-9),
+        '' if same else ', text differs'))
+    return results, same
+
+
+def args_parser():
+    parser = argparse.ArgumentParser(description='build-booklet 中读写 docx 的性能测试')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate = subparsers.add_parser('generate', help="生成测试论文")
+    generate.add_argument('directory', help="保存论文的目录")
+    generate.add_argument('-n', '--count', type=int, default=50, help="论文数量 (默认 50)")
+    generate.add_argument('--pages', type=int, default=12, help="每篇论文的页数 (默认 12)")
+    generate.add_argument('--tables', type=int, default=4, help="每篇论文的表格数 (默认 4)")
+    generate.add_argument('--seed', type=int, default=0, help="随机数种子")
+    generate.set_defaults(func=bench_generate)
+
+    parse = subparsers.add_parser('parse', help="对比流式读取和 python-docx 读取论文的时间")
+    parse.add_argument('papers', nargs='*', help="论文，默认当前目录下所有 docx")
+    parse.set_defaults(func=bench_parse)
+
+    writer = subparsers.add_parser('writer', help="对比逐个添加段落和批量写入作者索引的时间")
+    writer.add_argument('directory', help="保存生成的作者索引的目录")
+    writer.add_argument('-n', '--count', type=int, default=5000, help="作者索引的条目数 (默认 5000)")
+    writer.add_argument('--seed', type=int, default=0, help="随机数种子")
+    writer.set_defaults(func=bench_writer)
+
+    for sub in (generate, parse, writer):
+        sub.add_argument('-o', '--output', help="以 JSON 格式保存结果")
+    return parser
+
+
+def main():
+    args = args_parser().parse_args()
+    results, ok = args.func(args)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, ensure_ascii=False, indent=2)
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
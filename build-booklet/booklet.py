@@ -0,0 +1,102 @@
+"""
+论文集的分组 (track) 和页码表
+
+页码表只计算一次：按照 track 和 track 内论文的顺序累加页数，
+得到每篇论文的 track 编号、track 内序号和起始页码
+"""
+
+import os
+import importlib.util
+from collections import OrderedDict
+
+from paperinfo import PaperCache
+
+
+# Python 3.7 之后 dict 的 keys 保证和添加时顺序一致
+tracks = OrderedDict([
+    ('Theory and Experiment', 'theory-and-experiment.txt'),
+    ('Multimedia Technology', 'multimedia-technology.txt'),
+    ('Embedded System and Others', 'embedded-system-and-others.txt'),
+])
+
+
+def load_script(name):
+    """加载 build-booklet 目录下文件名中带 '-' 的脚本，如 load_script('generate-autorindex')"""
+    prefix = os.path.split(os.path.abspath(__file__))[0]
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), os.path.join(prefix, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def read_file_list(fname):
+    """读取 track 中的论文列表，每行一个论文 id"""
+    with open(fname) as fp:
+        return [id_.strip()+'.docx' for id_ in fp.readlines() if id_.strip() != '']
+
+
+class Entry:
+    """页码表中的一篇论文"""
+
+    def __init__(self, paper, track_no, track_name, no, start):
+        self.paper = paper
+        self.track_no = track_no
+        self.track_name = track_name
+        self.no = no            # track 内的序号，从 1 开始
+        self.start = start      # 起始页码
+
+    @property
+    def fname(self):
+        return self.paper.fname
+
+    @property
+    def label(self):
+        """论文编号，如 #01_02"""
+        return f"#{self.track_no:02}_{self.no:02}"
+
+
+class PageTable:
+    """所有论文的页码表"""
+
+    def __init__(self, track_names, entries):
+        self._track_names = list(track_names)
+        self._entries = list(entries)
+
+    @classmethod
+    def build(cls, tracks=tracks, cache=None, jobs=None):
+        """
+        读取所有 track 的论文列表和论文信息，计算页码表
+        :param cache: PaperCache，默认使用当前目录下的缓存
+        :param jobs:  读取论文的进程数，默认为 CPU 核数
+        """
+
+        flists = [read_file_list(track_file) for track_file in tracks.values()]
+        cache = cache or PaperCache()
+        papers = iter(cache.get_many([fname for flist in flists for fname in flist], jobs))
+        cache.save()
+
+        entries = []
+        start = 1
+        for track_no, (track_name, flist) in enumerate(zip(tracks.keys(), flists), 1):
+            for no, paper in enumerate((next(papers) for _ in flist), 1):
+                entries.append(Entry(paper, track_no, track_name, no, start))
+                start += paper.pages
+        return cls(tracks.keys(), entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def by_track(self):
+        """[(track 编号, track 名称, [Entry, ...]), ...]，包括没有论文的 track"""
+        groups = [(no, name, []) for no, name in enumerate(self._track_names, 1)]
+        for entry in self._entries:
+            groups[entry.track_no - 1][2].append(entry)
+        return groups
+
+    @property
+    def pages(self):
+        """所有论文的总页数"""
+        return sum(entry.paper.pages for entry in self._entries)
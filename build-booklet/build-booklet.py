@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import hashlib
+import argparse
+
+from booklet import tracks, read_file_list, load_script, PageTable
+from paperinfo import PaperCache, file_signature
+
+__doc__ = """
+一次生成论文集需要的所有文件：
+    content  论文目录 content.docx
+    authors  作者索引 author-index.docx
+    papers   以论文编号和起始页码命名的论文副本 ../papers/#<track>_<no>.<page>.docx
+    meta     论文信息 meta-information.xlsx
+
+所有论文只读取一次（并使用 paperinfo 的缓存），页码表只计算一次。
+每个步骤的输入（论文列表、论文、模板、脚本）没有改变并且输出已经存在时跳过这个步骤
+"""
+
+# 记录每个步骤上次运行时的输入
+STAMP_FILE = '.build-booklet.json'
+
+prefix = os.path.split(os.path.abspath(__file__))[0]
+
+
+def stage_content(table, args):
+    script = load_script('generate-paperindex')
+    script.format_out(args.content, table=table)
+
+
+def stage_authors(table, args):
+    script = load_script('generate-autorindex')
+    authors = script.fetch_author_information(table)
+    if args.authors.endswith('.csv'):
+        authors.write_csv(args.authors)
+    else:
+        script.format_out(authors, args.authors)
+
+
+def stage_papers(table, args):
+    script = load_script('insert-pages-number')
+    script.copy_papers(table, args.papers_dir)
+
+
+def stage_meta(table, args):
+    script = load_script('meta-information')
+    script.write_information((script.read_information(entry.paper) for entry in table), args.meta)
+
+
+# 步骤名称: (运行函数, 脚本, 模板, 输出)
+stages = {
+    'content': (stage_content, 'generate-paperindex', 'paper-index.docx', lambda args: [args.content]),
+    'authors': (stage_authors, 'generate-autorindex', 'author-index.docx', lambda args: [args.authors]),
+    'papers': (stage_papers, 'insert-pages-number', None, lambda args: [args.papers_dir]),
+    'meta': (stage_meta, 'meta-information', None, lambda args: [args.meta]),
+}
+
+
+def signature(path):
+    return file_signature(path) if os.path.exists(path) else None
+
+
+def inputs_digest(stage, papers, args):
+    """
+    步骤的所有输入的摘要，只需要 stat，不需要读取论文
+    输入包括：track 的论文列表、论文文件、模板、脚本（包括共用的模块）
+    """
+
+    _, script, template, _ = stages[stage]
+    files = list(tracks.values()) + papers
+    modules = ('booklet.py', 'paperinfo.py', 'authorindex.py', 'docxwriter.py')
+    files += [os.path.join(prefix, name) for name in (script + '.py',) + modules]
+    if template:
+        files.append(os.path.join(prefix, 'templates', template))
+    data = [[path, signature(path)] for path in files] + [stage, stages[stage][3](args)]
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def outputs_exist(stage, args):
+    return all(os.path.exists(path) for path in stages[stage][3](args))
+
+
+def load_stamps():
+    if not os.path.isfile(STAMP_FILE):
+        return {}
+    with open(STAMP_FILE) as fp:
+        return json.load(fp)
+
+
+def save_stamps(stamps):
+    with open(STAMP_FILE + '.tmp', 'w') as fp:
+        json.dump(stamps, fp, indent=1)
+    os.replace(STAMP_FILE + '.tmp', STAMP_FILE)
+
+
+def args_parser():
+    parser = argparse.ArgumentParser(description='生成论文集需要的所有文件')
+    parser.add_argument('stages',
+            nargs='*',
+            help="运行的步骤: {} (默认全部)".format(' '.join(stages)))
+    parser.add_argument('-f', '--force',
+            action='store_true',
+            default=False,
+            help="输入没有改变也重新运行")
+    parser.add_argument('-j', '--jobs',
+            type=int,
+            default=None,
+            help="读取论文的进程数 (默认为 CPU 核数)")
+    parser.add_argument('--content', default='content.docx', help="论文目录 (默认 content.docx)")
+    parser.add_argument('--authors', default='author-index.docx', help="作者索引，以 .csv 结尾时保存为 CSV (默认 author-index.docx)")
+    parser.add_argument('--papers-dir', default='../papers', help="论文副本目录 (默认 ../papers)")
+    parser.add_argument('--meta', default='meta-information.xlsx',
+            help="论文信息，以 .csv 结尾时保存为 CSV (默认 meta-information.xlsx)")
+    return parser
+
+
+def main():
+    parser = args_parser()
+    args = parser.parse_args()
+    for stage in args.stages:
+        if stage not in stages:
+            parser.error("invalid stage: '{}' (choose from {})".format(stage, ', '.join(stages)))
+    selected = args.stages or list(stages)
+
+    papers = [fname for track_file in tracks.values() for fname in read_file_list(track_file)]
+    stamps = load_stamps()
+    todo = []
+    for stage in selected:
+        digest = inputs_digest(stage, papers, args)
+        if not args.force and stamps.get(stage) == digest and outputs_exist(stage, args):
+            print("{}: up to date".format(stage))
+            continue
+        todo.append((stage, digest))
+    if not todo:
+        return
+
+    table = PageTable.build(cache=PaperCache(), jobs=args.jobs)
+    print("{} papers, {} pages".format(len(table), table.pages))
+    for entry in table:
+        if entry.paper.pages_source != 'app.xml':
+            print("{}: {} pages (from {})".format(entry.fname, entry.paper.pages, entry.paper.pages_source))
+    for stage, digest in todo:
+        print("{}: building ...".format(stage))
+        stages[stage][0](table, args)
+        stamps[stage] = digest
+        save_stamps(stamps)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,98 +1,600 @@
 #!/usr/bin/env python3
 
 import os
-import glob
 import re
+import csv
+import json
+import struct
+import hashlib
+import zipfile
+import argparse
+import posixpath
+from glob import glob
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from xml.etree import ElementTree
 
-from docx import Document
+import paperinfo
+from paperinfo import W, iter_paragraphs, docx_paragraphs, classify_front_matter
 
+__doc__ = """
+检查论文格式
 
-def check_title(paragraph):
-    pass
+每篇论文只解析一次（ParsedPaper），所有检查规则共用；规则用 @rule 注册，
+返回 [(位置, 问题), ...]。检查结果按照论文内容的 sha1 缓存在 CACHE_FILE 中，
+论文没有改变时不再检查；修改本脚本（规则）后缓存失效
 
+图片和表格只从 word/document.xml、[Content_Types].xml 和关系文件中读取：
+图片文件的大小来自 zip 的目录，格式、像素和 DPI 只读取图片开头的 IMAGE_HEADER_SIZE 字节，
+不会把整个图片读入内存
+"""
 
-def check_authors(paragraph):
-    authors = paragraph.text
+# 检查结果的缓存，保存在运行脚本的目录下
+CACHE_FILE = '.check-cache.json'
+
+WP = '{http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing}'
+A = '{http://schemas.openxmlformats.org/drawingml/2006/main}'
+R = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+V = '{urn:schemas-microsoft-com:vml}'
+O = '{urn:schemas-microsoft-com:office:office}'
+PR = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+CT = '{http://schemas.openxmlformats.org/package/2006/content-types}'
+
+EMU_PER_INCH = 914400
+TWIPS_PER_CM = 1440 / 2.54
+
+# 读取图片开头的字节数，PNG 的 pHYs 和 JPEG 的 JFIF、SOF 一般都在这个范围内
+IMAGE_HEADER_SIZE = 16 * 1024
+# 图片文件的最大大小
+MAX_PICTURE_SIZE = 5 * 1024 * 1024
+# 打印时图片的最低分辨率
+MIN_PICTURE_DPI = 150
+# 可以使用的图片格式
+PICTURE_FORMATS = {'png', 'jpeg', 'gif', 'emf', 'wmf'}
+
+# [Content_Types].xml 中的类型对应的格式
+CONTENT_FORMATS = {
+    'image/png': 'png',
+    'image/jpeg': 'jpeg',
+    'image/gif': 'gif',
+    'image/bmp': 'bmp',
+    'image/tiff': 'tiff',
+    'image/x-emf': 'emf',
+    'image/x-wmf': 'wmf',
+}
+
+# 规则名称: 检查函数，按照注册的顺序运行
+rules = OrderedDict()
+
+
+def rule(name):
+    """注册检查规则，规则函数的参数为 ParsedPaper，返回 [(位置, 问题), ...]"""
+    def register(func):
+        rules[name] = func
+        return func
+    return register
+
+
+def location(no):
+    """段落的位置，no 从 0 开始"""
+    return f"paragraph {no + 1}"
+
+
+class Media:
+    """word/media 下的一个图片文件"""
+
+    def __init__(self, part, size, format, width=None, height=None, dpi=None):
+        self.part = part
+        self.size = size        # 文件大小，来自 zip 的目录
+        self.format = format
+        self.width = width      # 像素
+        self.height = height
+        self.dpi = dpi          # 图片中记录的 DPI，没有记录时为 None
+
+
+class Picture:
+    """正文中的一个图片"""
+
+    def __init__(self, location, name, rel_id, cx=None, cy=None):
+        self.location = location
+        self.name = name
+        self.rel_id = rel_id
+        self.cx = cx            # 显示的宽度 (EMU)，VML 图片为 None
+        self.cy = cy
+        self.target = None      # 关系中的目标
+        self.external = False   # 链接到外部文件的图片
+        self.media = None       # Media，文件不存在时为 None
+
+
+class Table:
+    """正文中的一个表格（包括嵌套的表格）"""
+
+    def __init__(self, location, rows, width, nested):
+        self.location = location
+        self.rows = rows
+        self.width = width      # 各列宽度之和 (twips)
+        self.nested = nested    # 是否包含嵌套的表格
+
+
+class Layout:
+    """论文中的图片、表格和版心宽度"""
+
+    def __init__(self):
+        self.pictures = []
+        self.tables = []
+        self.text_width = None  # 版心宽度 (twips)
+
+
+def image_header(head):
+    """
+    从图片开头的字节中读取格式、像素和 DPI
+    :return: (格式, 宽, 高, dpi)，不能识别的部分为 None
+    """
+
+    if head.startswith(b'\x89PNG\r\n\x1a\n') and len(head) >= 24:
+        width, height = struct.unpack('>II', head[16:24])
+        dpi = None
+        pos = 8
+        while pos + 8 <= len(head):
+            length, kind = struct.unpack('>I4s', head[pos:pos + 8])
+            if kind == b'pHYs' and pos + 17 <= len(head):
+                ppu, _, unit = struct.unpack('>IIB', head[pos + 8:pos + 17])
+                if unit == 1:
+                    dpi = round(ppu * 0.0254)
+                break
+            if kind == b'IDAT':
+                break
+            pos += length + 12
+        return 'png', width, height, dpi
+
+    if head.startswith(b'\xff\xd8'):
+        width = height = dpi = None
+        pos = 2
+        while pos + 4 <= len(head) and head[pos] == 0xff:
+            marker = head[pos + 1]
+            if marker == 0xff:
+                pos += 1
+                continue
+            if marker == 0x01 or 0xd0 <= marker <= 0xd8:
+                pos += 2
+                continue
+            length = struct.unpack('>H', head[pos + 2:pos + 4])[0]
+            segment = head[pos + 4:pos + 2 + length]
+            if marker == 0xe0 and segment[:5] == b'JFIF\0' and len(segment) >= 12:
+                units, density = segment[7], struct.unpack('>H', segment[8:10])[0]
+                if units == 1:
+                    dpi = density
+                elif units == 2:
+                    dpi = round(density * 2.54)
+            elif 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc) and len(segment) >= 5:
+                height, width = struct.unpack('>HH', segment[1:5])
+                break
+            elif marker == 0xda:
+                break
+            pos += 2 + length
+        return 'jpeg', width, height, dpi
+
+    if head[:6] in (b'GIF87a', b'GIF89a') and len(head) >= 10:
+        width, height = struct.unpack('<HH', head[6:10])
+        return 'gif', width, height, None
+    if head[:2] == b'BM' and len(head) >= 42:
+        width, height, ppm = struct.unpack('<ii12xi', head[18:42])
+        return 'bmp', width, abs(height), (round(ppm * 0.0254) or None)
+    if head[:4] in (b'II*\0', b'MM\0*'):
+        return 'tiff', None, None, None
+    if head[:4] == b'\x01\0\0\0' and head[40:44] == b' EMF':
+        return 'emf', None, None, None
+    if head[:4] in (b'\xd7\xcd\xc6\x9a', b'\x01\0\x09\0', b'\x02\0\x09\0'):
+        return 'wmf', None, None, None
+    return None, None, None, None
+
+
+def content_types(zf):
+    """[Content_Types].xml：(扩展名: 类型, 部件名: 类型)"""
+    defaults, overrides = {}, {}
+    root = ElementTree.fromstring(zf.read('[Content_Types].xml'))
+    for elem in root.iter(CT + 'Default'):
+        defaults[elem.get('Extension', '').lower()] = elem.get('ContentType')
+    for elem in root.iter(CT + 'Override'):
+        overrides[elem.get('PartName', '').lstrip('/')] = elem.get('ContentType')
+    return defaults, overrides
+
+
+def relationships(zf, part='word/document.xml'):
+    """part 的关系：{Id: (目标, 是否外部)}，内部目标转换为 zip 中的文件名"""
+    base, name = posixpath.split(part)
+    try:
+        root = ElementTree.fromstring(zf.read(posixpath.join(base, '_rels', name + '.rels')))
+    except KeyError:
+        return {}
+    rels = {}
+    for elem in root.iter(PR + 'Relationship'):
+        target = elem.get('Target', '')
+        if elem.get('TargetMode') == 'External':
+            rels[elem.get('Id')] = (target, True)
+        elif target.startswith('/'):
+            rels[elem.get('Id')] = (target.lstrip('/'), False)
+        else:
+            rels[elem.get('Id')] = (posixpath.normpath(posixpath.join(base, target)), False)
+    return rels
+
+
+def read_media(zf, part, types):
+    """读取图片文件的大小和开头的 IMAGE_HEADER_SIZE 字节，文件不存在时返回 None"""
+    try:
+        info = zf.getinfo(part)
+    except KeyError:
+        return None
+    with zf.open(info) as fp:
+        head = fp.read(IMAGE_HEADER_SIZE)
+    format, width, height, dpi = image_header(head)
+    if format is None:
+        defaults, overrides = types
+        content_type = overrides.get(part) or defaults.get(posixpath.splitext(part)[1][1:].lower())
+        format = CONTENT_FORMATS.get(content_type, content_type)
+    return Media(part, info.file_size, format, width, height, dpi)
+
+
+def table_width(tbl):
+    """表格的宽度 (twips)：w:tblGrid 各列之和与每行单元格宽度 (w:tcW) 之和中最大的"""
+    grid = tbl.find(W + 'tblGrid')
+    widths = [0 if grid is None else sum(int(col.get(W + 'w', 0)) for col in grid)]
+    for tr in tbl.findall(W + 'tr'):
+        cells = [tc.find(W + 'tcPr/' + W + 'tcW') for tc in tr.findall(W + 'tc')]
+        widths.append(sum(int(tcw.get(W + 'w', 0)) for tcw in cells
+                          if tcw is not None and tcw.get(W + 'type', 'dxa') == 'dxa'))
+    return max(widths)
+
+
+def scan_layout(fname):
+    """流式读取 word/document.xml 中的图片、表格和版心宽度，图片只读取开头的字节"""
+    layout = Layout()
+    with zipfile.ZipFile(fname) as zf:
+        with zf.open('word/document.xml') as fp:
+            depth = 0
+            paragraph_no = 0    # 已经读完的正文段落数
+            table_no = 0
+            table_depth = 0
+            for event, elem in ElementTree.iterparse(fp, events=('start', 'end')):
+                tag = elem.tag
+                if event == 'start':
+                    depth += 1
+                    if tag == W + 'tbl':
+                        table_no += table_depth == 0
+                        table_depth += 1
+                    continue
+                depth -= 1
+                where = f"table {table_no}" if table_depth else location(paragraph_no)
+                if tag == W + 'drawing':
+                    blip = elem.find('.//' + A + 'blip')
+                    if blip is not None:
+                        extent = elem.find('.//' + WP + 'extent')
+                        doc_pr = elem.find('.//' + WP + 'docPr')
+                        cx, cy = (None, None) if extent is None else (int(extent.get('cx')), int(extent.get('cy')))
+                        layout.pictures.append(Picture(where, '' if doc_pr is None else doc_pr.get('name', ''),
+                                                       blip.get(R + 'embed') or blip.get(R + 'link'), cx, cy))
+                elif tag == V + 'imagedata':
+                    layout.pictures.append(Picture(where, elem.get(O + 'title', ''), elem.get(R + 'id')))
+                elif tag == W + 'tbl':
+                    table_depth -= 1
+                    if table_depth == 0:
+                        layout.tables.append(Table(where, len(elem.findall(W + 'tr')), table_width(elem),
+                                                   elem.find('.//' + W + 'tbl') is not None))
+                elif tag == W + 'sectPr' and depth == 2:
+                    # 正文最后的 w:sectPr 是整篇论文的页面设置
+                    size, margin = elem.find(W + 'pgSz'), elem.find(W + 'pgMar')
+                    if size is not None and margin is not None:
+                        layout.text_width = (int(size.get(W + 'w', 0)) - int(margin.get(W + 'left', 0))
+                                             - int(margin.get(W + 'right', 0)))
+                if depth == 2:
+                    paragraph_no += tag == W + 'p'
+                    elem.clear()
+
+        rels = relationships(zf)
+        types = content_types(zf)
+        media = {}
+        for picture in layout.pictures:
+            if picture.rel_id not in rels:
+                continue
+            picture.target, picture.external = rels[picture.rel_id]
+            if picture.external:
+                continue
+            if picture.target not in media:
+                media[picture.target] = read_media(zf, picture.target, types)
+            picture.media = media[picture.target]
+    return layout
+
+
+class ParsedPaper:
+    """检查规则共用的论文内容"""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._layout = None
+        try:
+            self.paragraphs = list(iter_paragraphs(fname))
+        except (KeyError, ElementTree.ParseError):
+            self.paragraphs = list(docx_paragraphs(fname))
+        # 论文开头各类段落的序号，类型见 paperinfo.classify_front_matter
+        self.front = {}
+        for no, kind, _, _ in classify_front_matter(iter(self.paragraphs)):
+            self.front.setdefault(kind, []).append(no)
+
+    def first(self, kind):
+        """第一个 kind 类型段落的序号，没有时为 None"""
+        return self.front.get(kind, [None])[0]
+
+    def paragraph(self, no):
+        return None if no is None else self.paragraphs[no]
+
+    @property
+    def title(self):
+        return self.paragraph(self.first(paperinfo.TITLE))
+
+    @property
+    def authors(self):
+        return self.paragraph(self.first(paperinfo.AUTHORS))
+
+    @property
+    def address(self):
+        return [self.paragraphs[no] for no in self.front.get(paperinfo.AFFILIATION, [])]
+
+    @property
+    def email(self):
+        return self.paragraph(self.first(paperinfo.EMAIL))
+
+    @property
+    def layout(self):
+        """图片和表格 (Layout)，第一次使用时读取"""
+        if self._layout is None:
+            self._layout = scan_layout(self.fname)
+        return self._layout
+
+
+@rule('structure')
+def check_structure(paper):
+    if not paper.paragraphs:
+        return [('', "empty paper")]
+    if paper.authors is None:
+        return [('', "paper is not complete, without AUTHORS information")]
+    if not paper.address and paper.email is None:
+        return [('', "paper is not complete, without ADDRESS information")]
+    problems = []
+    if paperinfo.ABSTRACT not in paper.front:
+        problems.append(('', "without ABSTRACT"))
+    if paperinfo.KEYWORDS not in paper.front:
+        problems.append(('', "without KEYWORDS"))
+    return problems
+
+
+@rule('title')
+def check_title(paper):
+    return []
+
+
+@rule('authors')
+def check_authors(paper):
+    if paper.authors is None:
+        return []
+    where = location(paper.first(paperinfo.AUTHORS))
+    authors = paper.authors.text
+    problems = []
     if re.search(r'\s{2,}', authors):
-        print("duplicated spaces")
+        problems.append((where, "duplicated spaces"))
     if re.search(r'，', authors):
-        print("full width version ',' ('，')")
+        problems.append((where, "full width version ',' ('，')"))
+    return problems
 
 
-def check_address(paragraphs):
-    pass
+@rule('address')
+def check_address(paper):
+    return []
 
-def end_of_address(paragraph):
-    text = paragraph.text.lower()
-    return text == '' or 'mail' in text
 
+@rule('email')
+def check_email(paper):
+    return []
 
-def check_email(paragraph):
-    pass
 
-
-def check_multi_empty_paragraphs(paragraphs):
+@rule('empty-paragraphs')
+def check_multi_empty_paragraphs(paper):
+    problems = []
     empty_cnt = 0
-    for no, p in enumerate(paragraphs, 1):
+    for no, p in enumerate(paper.paragraphs):
         if p.text.strip() == '':
             empty_cnt += 1
         else:
             if empty_cnt >= 3:
-                #pre = 100*(no/len(paragraphs))
-                print(f"{no}/{len(paragraphs)}: continuous empty paragraphs ({empty_cnt})")
-                print(p.text[:50])
+                problems.append((location(no), f"continuous empty paragraphs ({empty_cnt}) before: {p.text[:50]}"))
             empty_cnt = 0
+    return problems
+
+
+@rule('page')
+def check_page(paper):
+    return []
+
+
+@rule('tables')
+def check_tables(paper):
+    layout = paper.layout
+    problems = []
+    for table in layout.tables:
+        if table.rows == 0:
+            problems.append((table.location, "empty table"))
+        if table.nested:
+            problems.append((table.location, "nested table"))
+        if layout.text_width and table.width > layout.text_width * 1.01:
+            problems.append((table.location, "wider than the text area ({:.1f} cm > {:.1f} cm)".format(
+                table.width / TWIPS_PER_CM, layout.text_width / TWIPS_PER_CM)))
+    return problems
+
+
+@rule('pictures')
+def check_pictures(paper):
+    problems = []
+    for picture in paper.layout.pictures:
+        where = picture.location + (f" ({picture.name})" if picture.name else '')
+        if picture.external:
+            problems.append((where, f"linked picture, not embedded: {picture.target}"))
+            continue
+        media = picture.media
+        if media is None:
+            problems.append((where, "picture file missing"))
+            continue
+        if media.size > MAX_PICTURE_SIZE:
+            problems.append((where, "{}: {:.1f} MB, larger than {:.0f} MB".format(
+                media.part, media.size / 1024 / 1024, MAX_PICTURE_SIZE / 1024 / 1024)))
+        if media.format not in PICTURE_FORMATS:
+            problems.append((where, f"{media.part}: unsupported format {media.format}"))
+        # 打印时的分辨率由像素和显示的宽度决定，没有显示宽度时使用图片中记录的 DPI
+        if media.width and picture.cx:
+            dpi = media.width / (picture.cx / EMU_PER_INCH)
+        else:
+            dpi = media.dpi
+        if dpi and dpi < MIN_PICTURE_DPI:
+            problems.append((where, f"{media.part}: {dpi:.0f} dpi, lower than {MIN_PICTURE_DPI} dpi"))
+    return problems
+
 
+def check_file(fname):
+    """
+    解析一次 fname，运行所有规则
+    :return: [[规则, 位置, 问题], ...]
+    """
 
-def check_page(doc):
-    pass
+    paper = ParsedPaper(fname)
+    problems = []
+    for name, func in rules.items():
+        problems.extend([name, where, message] for where, message in func(paper))
+    return problems
 
 
-def check_tables(doc):
-    pass
+def file_hash(fname, bufsize=1024*1024):
+    sha1 = hashlib.sha1()
+    with open(fname, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(bufsize), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
 
 
-def check_pictures(doc):
-    pass
+def rules_version():
+    """规则的版本，本脚本或者读取段落的共用模块 paperinfo.py 修改后旧的检查结果失效"""
+    digest = hashlib.sha1()
+    for path in (os.path.abspath(__file__), paperinfo.__file__):
+        with open(path, 'rb') as fp:
+            digest.update(fp.read())
+    return digest.hexdigest()
 
 
-def check_all(fname):
-    print(f"checking {fname} ...")
-    if not os.path.exists(fname):
-        print(f"{fname}: file not exists.")
-        return False
-    doc = Document(fname)
-    paragraphs = doc.paragraphs
+class CheckCache:
+    """检查结果的缓存：论文内容的 sha1 -> [[规则, 位置, 问题], ...]"""
 
-    if not paragraphs:
-        print(f"{fname}: empty paper")
-        return False
-    check_title(paragraphs[0])
+    def __init__(self, path=CACHE_FILE):
+        self._path = path
+        self._version = rules_version()
+        self._entries = {}
+        self._modified = False
+        if path and os.path.isfile(path):
+            with open(path, encoding='utf-8') as fp:
+                data = json.load(fp)
+            if data.get('version') == self._version:
+                self._entries = data['papers']
 
-    if len(paragraphs) < 2:
-        print(f"{fname}: paper is not complete, without AUTHORS information")
-        return False
-    check_authors(doc.paragraphs[1])
+    def get(self, digest):
+        return self._entries.get(digest)
 
-    if len(paragraphs) < 3:
-        print(f"{fname}: paper is not complete, without ADDRESS information")
-        return False
-    for no, paragraph in enumerate(paragraphs[2:], 2):
-        if end_of_address(paragraph):
-            break
-    check_address(paragraphs[2:no])
+    def put(self, digest, problems):
+        self._entries[digest] = problems
+        self._modified = True
 
-    check_email(paragraphs[no])
+    def save(self):
+        if not self._path or not self._modified:
+            return
+        tmp = self._path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as fp:
+            json.dump({'version': self._version, 'papers': self._entries}, fp, ensure_ascii=False)
+        os.replace(tmp, self._path)
+        self._modified = False
 
-    check_multi_empty_paragraphs(paragraphs)
-    check_page(doc)
-    check_tables(doc)
-    check_pictures(doc)
+
+def check_all(fnames, cache=None, jobs=None):
+    """
+    检查所有论文，没有缓存结果的论文在多个进程中同时检查
+    :param jobs: 进程数，默认为 CPU 核数
+    :return:     [(论文, 规则, 位置, 问题), ...]，与 fnames 的顺序相同
+    """
+
+    cache = cache or CheckCache(None)
+    results = {}
+    misses = OrderedDict()
+    for fname in fnames:
+        if not os.path.exists(fname):
+            results[fname] = [['structure', '', "file not exists."]]
+            continue
+        digest = file_hash(fname)
+        problems = cache.get(digest)
+        if problems is None:
+            misses[fname] = digest
+        else:
+            results[fname] = problems
+
+    if len(misses) > 1 and jobs != 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            checked = list(executor.map(check_file, misses))
+    else:
+        checked = [check_file(fname) for fname in misses]
+    for (fname, digest), problems in zip(misses.items(), checked):
+        cache.put(digest, problems)
+        results[fname] = problems
+    return [(fname, name, where, message) for fname in fnames for name, where, message in results[fname]]
+
+
+def write_report(problems, fname):
+    """保存检查结果，fname 以 .csv 结尾时保存为 CSV，否则为 JSON"""
+    fields = ['paper', 'rule', 'location', 'message']
+    if fname.endswith('.csv'):
+        with open(fname, 'w', newline='', encoding='utf-8') as fp:
+            writer = csv.writer(fp)
+            writer.writerow(fields)
+            writer.writerows(problems)
+    else:
+        with open(fname, 'w', encoding='utf-8') as fp:
+            json.dump([dict(zip(fields, problem)) for problem in problems], fp, ensure_ascii=False, indent=1)
+
+
+def args_parser():
+    parser = argparse.ArgumentParser(description='检查论文格式')
+    parser.add_argument('papers',
+            nargs='*',
+            help="检查的论文 (默认为当前目录下所有 docx)")
+    parser.add_argument('-o', '--output',
+            help="保存检查结果，以 .csv 结尾时为 CSV，否则为 JSON")
+    parser.add_argument('-j', '--jobs',
+            type=int,
+            default=None,
+            help="检查论文的进程数 (默认为 CPU 核数)")
+    parser.add_argument('-f', '--force',
+            action='store_true',
+            default=False,
+            help="不使用缓存的检查结果")
+    return parser
 
 
 def main():
-    for fname in glob.glob('./*.docx'):
-        check_all(fname)
+    args = args_parser().parse_args()
+    fnames = args.papers or sorted(glob('*.docx'))
+    cache = CheckCache(None if args.force else CACHE_FILE)
+    problems = check_all(fnames, cache, args.jobs)
+    if not args.force:
+        cache.save()
+
+    if args.output:
+        write_report(problems, args.output)
+        print(f"{len(fnames)} papers, {len(problems)} problems")
+    else:
+        for fname, name, where, message in problems:
+            print(f"{fname}: {where + ': ' if where else ''}{message} [{name}]")
 
 
 if __name__ == '__main__':
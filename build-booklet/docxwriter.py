@@ -0,0 +1,111 @@
+"""
+批量写入 docx 正文
+
+python-docx 每次 add_paragraph / add_heading 都要单独修改一次文档的 XML 树，
+段落很多时很慢。BodyWriter 先把段落拼接为 XML 文本，最后一次解析后整块加入正文；
+制表位等格式放在样式中只定义一次，不需要在每个段落上设置
+"""
+
+from xml.sax.saxutils import escape
+
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls
+from docx.enum.style import WD_STYLE_TYPE
+
+
+def paragraph_style(doc, name, base='Normal', tab_stops=()):
+    """
+    获取段落样式 name，模板中没有时基于 base 新建
+    :param tab_stops: 新建样式的制表位 [(位置, 对齐方式, 前导符), ...]
+    :return:          样式的 style_id
+    """
+
+    try:
+        return doc.styles[name].style_id
+    except KeyError:
+        pass
+    style = doc.styles.add_style(name, WD_STYLE_TYPE.PARAGRAPH)
+    style.base_style = doc.styles[base]
+    for position, alignment, leader in tab_stops:
+        style.paragraph_format.tab_stops.add_tab_stop(position, alignment, leader)
+    return style.style_id
+
+
+def _text_xml(text):
+    """与 python-docx 的 Run.text 相同：'\\t' 转为 <w:tab/>，'\\n' 转为 <w:br/>"""
+    parts = []
+    for no, line in enumerate(text.split('\n')):
+        if no:
+            parts.append('<w:br/>')
+        for i, piece in enumerate(line.split('\t')):
+            if i:
+                parts.append('<w:tab/>')
+            if piece:
+                parts.append('<w:t xml:space="preserve">{}</w:t>'.format(escape(piece)))
+    return ''.join(parts)
+
+
+def _run_xml(text, superscript=None, all_caps=None):
+    """与 python-docx 的 add_run(text) 后设置 font.all_caps、font.superscript 相同"""
+    props = []
+    if all_caps is not None:
+        props.append('<w:caps/>' if all_caps else '<w:caps w:val="0"/>')
+    if superscript is not None:
+        props.append('<w:vertAlign w:val="{}"/>'.format('superscript' if superscript else 'baseline'))
+    rpr = '<w:rPr>{}</w:rPr>'.format(''.join(props)) if props else ''
+    return '<w:r>{}{}</w:r>'.format(rpr, _text_xml(text))
+
+
+class BodyWriter:
+    """
+    收集段落，flush 时一次加入文档正文的末尾（最后的 w:sectPr 之前）
+
+        writer = BodyWriter(doc)
+        writer.heading('A', 2)
+        writer.paragraph('ZHANG SAN\\t#01_02', style_id)
+        writer.flush()
+    """
+
+    def __init__(self, doc):
+        self._doc = doc
+        self._parts = []
+        self._heading_styles = {}
+
+    def __len__(self):
+        return len(self._parts)
+
+    def _append(self, runs_xml, style_id=None):
+        ppr = '<w:pPr><w:pStyle w:val="{}"/></w:pPr>'.format(escape(style_id)) if style_id else ''
+        self._parts.append('<w:p>{}{}</w:p>'.format(ppr, runs_xml))
+
+    def paragraph(self, text='', style_id=None):
+        """与 doc.add_paragraph(text) 相同，style_id 为样式的 id（不是名称）"""
+        self._append(_run_xml(text) if text else '', style_id)
+
+    def runs(self, runs, all_caps=None, style_id=None):
+        """
+        由多个 run 组成的段落
+        :param runs: [[文本, 是否上标], ...]
+        """
+        self._append(''.join(_run_xml(text, superscript, all_caps) for text, superscript in runs), style_id)
+
+    def heading(self, text, level=1):
+        """与 doc.add_heading(text, level) 相同"""
+        if level not in self._heading_styles:
+            name = 'Title' if level == 0 else 'Heading {}'.format(level)
+            self._heading_styles[level] = self._doc.styles[name].style_id
+        self.paragraph(text, self._heading_styles[level])
+
+    def flush(self):
+        """把收集的段落一次加入正文"""
+        if not self._parts:
+            return
+        block = parse_xml('<w:body {}>{}</w:body>'.format(nsdecls('w'), ''.join(self._parts)))
+        self._parts = []
+        body = self._doc.element.body
+        sect = body.sectPr
+        for p in list(block):
+            if sect is not None:
+                sect.addprevious(p)
+            else:
+                body.append(p)
@@ -1,64 +1,31 @@
 #!/usr/bin/env python3
 
-import re
-import zipfile
 import os
-from collections import OrderedDict
-from operator import add
-from functools import reduce
 
 from docx import Document
 from docx.shared import Inches, Cm
 from docx.enum.text import WD_TAB_ALIGNMENT, WD_TAB_LEADER
 
+from booklet import PageTable
+from authorindex import AuthorIndex
+from docxwriter import BodyWriter, paragraph_style
+
 __doc__ = """
 从论文中生成论文作者索引
 """
 
-
-tracks = OrderedDict({
-    'Theory and Experiment': 'theory-and-experiment.txt',
-    'Multimedia Technology': 'multimedia-technology.txt',
-    'Embedded System and Others': 'embedded-system-and-others.txt',
-})
-
-
-class Author:
-    def __init__(self, name, track_id, page_no):
-        self.name = name
-        self.track_id = track_id
-        self.page_no = page_no
-
-
-def read_file_list(fname):
-    with open(fname) as fp:
-        return [id_.strip()+'.docx' for id_ in fp.readlines()]
+# 作者索引条目的样式，模板中没有时新建，论文编号对齐到 4.5cm 处的制表位
+ENTRY_STYLE = 'Author Index Entry'
 
 
-def get_pages(doc):
-    """获取 docx 文档的页数"""
-    with zipfile.ZipFile(doc) as zf:
-        appxml = zf.read('docProps/app.xml').decode()
-        return int(re.search('(?<=<Pages>)\s*\d+\s*(?=</Pages>)', appxml).group(0))
-
-
-def read_authors(fname):
-    doc = Document(fname)
-    authors = doc.paragraphs[1].text
-    def normalize(name):
-        return re.sub(r'\s+', ' ', name.strip().upper())
-    name_sep = r'[\d\*]\s*|,|，'
-    return [normalize(name) for name in re.split(name_sep, authors) if name.strip() != '']
-
-
-def fetch_author_information():
-    authors = []
-    start = 1
-    for track_id, track_file in enumerate(tracks.values(), 1):
-        for id_, fname in enumerate(read_file_list(track_file), 1):
-            authors.append([Author(name, f"#{track_id:02}_{id_:02}", start) for name in read_authors(fname)])
-            start += get_pages(fname)
-    return reduce(add, authors, [])
+def fetch_author_information(table=None):
+    """
+    :param table: 页码表 (PageTable)，默认从当前目录读取
+    :return:      作者索引 (AuthorIndex)，按照 (作者名, 论文编号) 的顺序返回 Author
+    """
+    if table is None:
+        table = PageTable.build()
+    return AuthorIndex.from_table(table)
 
 
 def default_template():
@@ -84,26 +51,27 @@ def format_out(authors, output="author-index.docx", template=default_template())
     doc = Document(template)
     if doc.paragraphs and doc.paragraphs[-1].text == '':
         delete_paragraph(doc.paragraphs[-1])
+    entry_style = paragraph_style(doc, ENTRY_STYLE,
+            tab_stops=[(Cm(4.5), WD_TAB_ALIGNMENT.LEFT, WD_TAB_LEADER.SPACES)])
+    writer = BodyWriter(doc)
     NAME_LEN = 19
     index = None
     for author in authors:
         if author.name[0] != index:
             index = author.name[0]
-            doc.add_heading(index, 2)
+            writer.heading(index, 2)
         if len(author.name) >= NAME_LEN:
-            doc.add_paragraph(author.name)
-            p = doc.add_paragraph(f"\t{author.track_id}{' '*5}{author.page_no}")
+            writer.paragraph(author.name)
+            writer.paragraph(f"\t{author.track_id}{' '*5}{author.page_no}", entry_style)
         else:
-            p = doc.add_paragraph(f"{author.name}\t{author.track_id}{' '*5}{author.page_no}")
-        p.paragraph_format.tab_stops.add_tab_stop(Cm(4.5), WD_TAB_ALIGNMENT.LEFT, WD_TAB_LEADER.SPACES)
+            writer.paragraph(f"{author.name}\t{author.track_id}{' '*5}{author.page_no}", entry_style)
+    writer.flush()
 
     doc.save(output)
 
 
 def main():
-    authors = fetch_author_information()
-    authors.sort(key=lambda author: (author.name, author.track_id))
-    format_out(authors)
+    format_out(fetch_author_information())
 
 
 if __name__ == '__main__':
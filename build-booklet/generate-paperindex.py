@@ -1,67 +1,38 @@
 #!/usr/bin/env python3
 
 import os
-import re
-import zipfile
-from collections import OrderedDict
 
 from docx import Document
 
+from booklet import PageTable
+from docxwriter import BodyWriter
+
 __doc__ = """
 从论文中生成论文索引
 """
 
 title = "Content of Proceeding of 17th ICCWAMTIP"
-# Python 3.7 之后 dict 的 keys 保证和添加时顺序一致
-tracks = OrderedDict([
-    ('Theory and Experiment', 'theory-and-experiment.txt'),
-    ('Multimedia Technology', 'multimedia-technology.txt'),
-    ('Embedded System and Others', 'embedded-system-and-others.txt'),
-])
-
-def get_pages(doc):
-    """获取 docx 文档的页数"""
-    with zipfile.ZipFile(doc) as zf:
-        appxml = zf.read('docProps/app.xml').decode()
-        return int(re.search('(?<=<Pages>)\s*\d+\s*(?=</Pages>)', appxml).group(0))
-
-
-def read_file_list(flist):
-    with open(flist) as fp:
-        return [id_.strip()+'.docx' for id_ in fp.readlines()]
 
 
-def copy_paragraph(doc, paragraph, author=False):
-    p = doc.add_paragraph()
-    for run in paragraph.runs:
-        r = p.add_run(run.text)
-        r.font.superscript = run.font.superscript
-        r.font.all_caps = (author == True)
+def copy_paragraph(writer, runs, author=False):
+    """runs: [[文本, 是否上标], ...]"""
+    writer.runs(runs, all_caps=(author == True))
 
 
-def end_of_content(paragraph):
-    return paragraph == '' or 'mail' in paragraph.lower()
-
-
-def append_content(dst, track_no, no, fname, start):
-    src = Document(fname)
-    paper_title = src.paragraphs[0].text.strip()
+def append_content(writer, track_no, no, paper, start):
+    paper_title = paper.title.strip()
     title = "#{:02}_{:02}: {}{}".format(track_no, no, paper_title, start).upper()
-    dst.add_heading(title, 3)
-    for no, paragraph in enumerate(src.paragraphs[1:]):
-        if end_of_content(paragraph.text):
-            break
-        copy_paragraph(dst, paragraph, (0 == no))
-    dst.add_paragraph()
+    writer.heading(title, 3)
+    for no, runs in enumerate(paper.front):
+        copy_paragraph(writer, runs, (0 == no))
+    writer.paragraph()
 
 
-def add_track(doc, track_no, track_name, flist, start):
+def add_track(writer, track_no, track_name, entries):
     track_title = "Track {:02}: {}".format(track_no, track_name)
-    doc.add_heading(track_title, 2)
-    for no, fname in enumerate(flist, 1):
-        append_content(doc, track_no, no, fname, start)
-        start += get_pages(fname)
-    return start
+    writer.heading(track_title, 2)
+    for entry in entries:
+        append_content(writer, track_no, entry.no, entry.paper, entry.start)
 
 
 def delete_paragraph(paragraph):
@@ -83,14 +54,20 @@ def default_template():
     return template if path.exists(template) else None
 
 
-def format_out(fname='content.docx', template=default_template()):
+def format_out(fname='content.docx', template=default_template(), table=None):
+    """
+    :param table: 页码表 (PageTable)，默认从当前目录读取
+    """
     doc = Document(template)
     if doc.paragraphs and doc.paragraphs[-1].text == '':
         delete_paragraph(doc.paragraphs[-1])
-    doc.add_heading(title, 1)
-    start = 1
-    for no, name in enumerate(tracks.keys(), 1):
-        start = add_track(doc, no, name, read_file_list(tracks[name]), start)
+    writer = BodyWriter(doc)
+    writer.heading(title, 1)
+    if table is None:
+        table = PageTable.build()
+    for no, name, entries in table.by_track():
+        add_track(writer, no, name, entries)
+    writer.flush()
     doc.save(fname)
 
 
@@ -1,46 +1,32 @@
 #!/usr/bin/env python3
 
 import os
-import re
 import shutil
-import zipfile
-from collections import OrderedDict
 
-from docx import Document
+from booklet import PageTable
 
 
-tracks = OrderedDict({
-    'Theory and Experiment': 'theory-and-experiment.txt',
-    'Multimedia Technology': 'multimedia-technology.txt',
-    'Embedded System and Others': 'embedded-system-and-others.txt',
-})
+def paper_copy_name(entry, dir='../papers'):
+    """论文复制后的文件名: <dir>/#<track>_<no>.<起始页码>.docx"""
+    return os.path.join(dir, f"{entry.label}.{entry.start}.docx")
 
 
-def read_file_list(fname):
-    with open(fname) as fp:
-        return [id.strip()+'.docx' for id in fp.readlines() if id.strip() != '']
-
-
-def get_pages(doc):
-    """获取 docx 文档的页数"""
-    with zipfile.ZipFile(doc) as zf:
-        appxml = zf.read('docProps/app.xml').decode()
-        return int(re.search('(?<=<Pages>)\s*\d+\s*(?=</Pages>)', appxml).group(0))
-
-
-def main():
-    dir = '../papers'
+def copy_papers(table=None, dir='../papers'):
+    """
+    将论文复制到 dir 目录下，并以论文编号和起始页码命名
+    :param table: 页码表 (PageTable)，默认从当前目录读取
+    """
     #shutil.rmtree(dir, ignore_errors=True)
     if not os.path.exists(dir):
         os.mkdir(dir)
-    start = 1
-    for track_id, fname in enumerate(tracks.values(), 1):
-        for no, name in enumerate(read_file_list(fname), 1):
-            new_name = os.path.join(dir, f"#{track_id:02}_{no:02}.{start}.docx")
-            shutil.copyfile(new_name, name)
-            #shutil.copyfile(name, new_name)
-            start += get_pages(name)
+    if table is None:
+        table = PageTable.build()
+    for entry in table:
+        shutil.copyfile(entry.fname, paper_copy_name(entry, dir))
+
 
+def main():
+    copy_papers()
 
 
 if __name__ == '__main__':
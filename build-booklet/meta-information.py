@@ -5,47 +5,70 @@
 """
 
 import re
+import csv
+import argparse
 from glob import glob
 
-from docx import Document
 from openpyxl import Workbook
 
+from paperinfo import PaperCache
 
-def read_authors(fname):
-    doc = Document(fname)
-    authors = doc.paragraphs[1].text
-    def normalize(name):
-        return re.sub(r'\s+', ' ', name.strip().upper())
-    name_sep = r'[\d\*]\s*|,|，'
-    return [normalize(name) for name in re.split(name_sep, authors) if name.strip() != '']
 
+# CSV 的表头，xlsx 没有表头
+FIELDS = ['title', 'first_author', 'institution', 'keywords', 'abstract']
 
-def read_information(fname):
-    doc = Document(fname)
-    title = doc.paragraphs[0].text.upper()
-    first_author = read_authors(fname)[0]
-    institution = doc.paragraphs[2].text
-    institution = re.sub(r'^\d{1,1}\s*(?=\w)|^\d{1,1}\s*(,\s*\d{1,1}\s*)+', '', doc.paragraphs[2].text)
-    for i, p in enumerate(doc.paragraphs):
-        if 'abstract:' == p.text.lower().strip():
-            abstract = doc.paragraphs[i+1].text
-        elif 'keywords:' == p.text.lower().strip():
-            keywords = doc.paragraphs[i+1].text
-            break
-    return [title, first_author, institution, keywords, abstract]
+
+def read_information(paper):
+    title = paper.title.upper()
+    first_author = paper.author_names[0] if paper.author_names else ''
+    institution = paper.affiliations[0] if paper.affiliations else ''
+    institution = re.sub(r'^\d{1,1}\s*(?=\w)|^\d{1,1}\s*(,\s*\d{1,1}\s*)+', '', institution)
+    return [title, first_author, institution, paper.keywords, paper.abstract]
 
 
 def write_xlsx(data, fname="meta-information.xlsx"):
-    workbook = Workbook()
-    worksheet = workbook.active
-    for row, rcd in enumerate(data, 1):
-        for col, cell in enumerate(rcd, 1):
-            worksheet.cell(row, col, cell)
+    """只写模式的 workbook，每一行写入后就不再保存在内存中"""
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet()
+    for rcd in data:
+        worksheet.append(rcd)
     workbook.save(fname)
 
 
+def write_csv(data, fname="meta-information.csv"):
+    with open(fname, 'w', newline='', encoding='utf-8') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(FIELDS)
+        writer.writerows(data)
+
+
+def write_information(data, fname="meta-information.xlsx"):
+    """fname 以 .csv 结尾时保存为 CSV，否则为 xlsx"""
+    if fname.endswith('.csv'):
+        write_csv(data, fname)
+    else:
+        write_xlsx(data, fname)
+
+
+def args_parser():
+    parser = argparse.ArgumentParser(description='从论文中提取作者信息')
+    parser.add_argument('output',
+            nargs='?',
+            default='meta-information.xlsx',
+            help="输出文件，以 .csv 结尾时保存为 CSV (默认 meta-information.xlsx)")
+    parser.add_argument('-j', '--jobs',
+            type=int,
+            default=None,
+            help="读取论文的进程数 (默认为 CPU 核数)")
+    return parser
+
+
 def main():
-    write_xlsx(read_information(fname) for fname in glob('*.docx'))
+    args = args_parser().parse_args()
+    cache = PaperCache()
+    papers = cache.iter_many(sorted(glob('*.docx')), args.jobs)
+    write_information((read_information(paper) for paper in papers), args.output)
+    cache.save()
 
 
 if __name__ == '__main__':
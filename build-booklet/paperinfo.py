@@ -0,0 +1,466 @@
+"""
+从论文中提取生成论文集需要的信息（题目、作者、单位、摘要、关键字、页数等）
+
+每篇论文只打开一次，结果按照 路径 + 修改时间 + 文件大小
+缓存在 CACHE_FILE (sqlite 数据库，每篇论文一行) 中，论文没有改变时直接使用缓存
+
+默认直接从 word/document.xml 中流式读取段落，读到需要的信息后就停止，
+不需要 python-docx 解析整篇论文；读取失败时再使用 python-docx
+"""
+
+import os
+import re
+import json
+import shutil
+import sqlite3
+import zipfile
+import tempfile
+import subprocess
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor
+from xml.etree import ElementTree
+
+from docx import Document
+
+
+# 缓存文件，保存在论文所在的目录（运行脚本的目录）下
+CACHE_FILE = '.paper-cache.sqlite'
+# 提取的内容改变后修改版本号，让旧的缓存失效
+CACHE_VERSION = 4
+
+
+class Paper:
+    """一篇论文的信息"""
+
+    def __init__(self, fname, title='', authors='', affiliations=None, email='',
+                 abstract='', keywords='', body_start=None, pages=0, pages_source=None, front=None):
+        self.fname = fname
+        self.title = title                      # 题目
+        self.authors = authors                  # 作者行
+        self.affiliations = affiliations or []  # 作者单位（可能有多行）
+        self.email = email                      # 邮箱行
+        self.abstract = abstract
+        self.keywords = keywords
+        self.body_start = body_start            # 正文开始的段落序号，没有找到时为 None
+        self.pages = pages
+        self.pages_source = pages_source        # 页数的来源，见 count_pages
+        # 作者行开始到邮箱之前的段落，每个段落是 [[文本, 是否上标], ...]
+        self.front = front or []
+
+    @property
+    def author_names(self):
+        return split_authors(self.authors)
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+
+def split_authors(authors):
+    """将作者行拆分为规范化后的作者名列表"""
+    def normalize(name):
+        return re.sub(r'\s+', ' ', name.strip().upper())
+    name_sep = r'[\d\*]\s*|,|，'
+    return [normalize(name) for name in re.split(name_sep, authors) if name.strip() != '']
+
+
+W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+# 转换 docx 为 pdf 的命令，没有安装时不使用
+CONVERTERS = ['soffice', 'libreoffice']
+CONVERTER_TIMEOUT = 120
+
+
+def app_pages(zf):
+    """
+    Word、LibreOffice、WPS 等保存在 docProps/app.xml 中的页数，没有保存时返回 None
+    """
+
+    try:
+        appxml = zf.read('docProps/app.xml').decode('utf-8', 'replace')
+    except KeyError:
+        return None
+    pages = re.search(r'<Pages>\s*(\d+)\s*</Pages>', appxml)
+    if not pages:
+        return None
+    return int(pages.group(1)) or None
+
+
+def break_pages(zf):
+    """
+    根据 word/document.xml 中的分页估计页数
+    :return: (根据 Word 排版时记录的分页 w:lastRenderedPageBreak 得到的页数，没有记录时为 None,
+              根据手动插入的分页符和分节符得到的页数，是实际页数的下限)
+    """
+
+    rendered = 0
+    explicit = 0
+    tables = 0          # 当前所在表格的层数
+    row_break = False   # 当前最外层的表格行中是否已经有 w:lastRenderedPageBreak
+    with zf.open('word/document.xml') as fp:
+        for event, elem in ElementTree.iterparse(fp, events=('start', 'end')):
+            tag = elem.tag
+            if event == 'start':
+                if tag == W + 'tbl':
+                    tables += 1
+                elif tag == W + 'tr' and tables == 1:
+                    row_break = False
+                continue
+            if tag == W + 'lastRenderedPageBreak':
+                # 表格的一行从新的一页开始时，这一行的每个单元格中都有一个，只算一次
+                if not tables or not row_break:
+                    rendered += 1
+                    row_break = bool(tables)
+            elif tag == W + 'br' and elem.get(W + 'type') == 'page':
+                explicit += 1
+            elif tag == W + 'pageBreakBefore' and elem.get(W + 'val', 'true') not in ('false', '0', 'off'):
+                explicit += 1
+            elif tag == W + 'pPr':
+                # 段落中的 w:sectPr 表示一节的结束，默认下一节从新的一页开始
+                sect = elem.find(W + 'sectPr')
+                if sect is not None:
+                    type_ = sect.find(W + 'type')
+                    if type_ is None or type_.get(W + 'val', 'nextPage') != 'continuous':
+                        explicit += 1
+            if tag == W + 'tbl':
+                tables -= 1
+            if tag in (W + 'p', W + 'tbl'):
+                elem.clear()
+    return (rendered + 1 if rendered else None), explicit + 1
+
+
+def converter_pages(fname):
+    """安装了 LibreOffice 时，转换为 pdf 统计页数，否则返回 None"""
+    command = next((shutil.which(name) for name in CONVERTERS if shutil.which(name)), None)
+    if not command:
+        return None
+    with tempfile.TemporaryDirectory() as outdir:
+        try:
+            subprocess.run([command, '--headless', '--convert-to', 'pdf', '--outdir', outdir, fname],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                           timeout=CONVERTER_TIMEOUT, check=True)
+        except (OSError, subprocess.SubprocessError):
+            return None
+        pdf = os.path.join(outdir, os.path.splitext(os.path.basename(fname))[0] + '.pdf')
+        if not os.path.isfile(pdf):
+            return None
+        with open(pdf, 'rb') as fp:
+            return len(re.findall(rb'/Type\s*/Page(?![a-zA-Z])', fp.read())) or None
+
+
+def count_pages(fname):
+    """
+    获取 docx 文档的页数，依次尝试：
+        app.xml          Word 保存的页数
+        rendered-breaks  Word 排版时记录的分页
+        converter        转换为 pdf 后的页数（需要安装 LibreOffice）
+        explicit-breaks  手动插入的分页符和分节符，只是实际页数的下限
+    :return: (页数, 来源)
+    """
+
+    with zipfile.ZipFile(fname) as zf:
+        pages = app_pages(zf)
+        if pages:
+            return pages, 'app.xml'
+        rendered, explicit = break_pages(zf)
+    if rendered:
+        return max(rendered, explicit), 'rendered-breaks'
+    pages = converter_pages(fname)
+    if pages:
+        return pages, 'converter'
+    return explicit, 'explicit-breaks'
+
+
+def get_pages(doc):
+    """获取 docx 文档的页数"""
+    return count_pages(doc)[0]
+
+
+class Paragraph:
+    """段落的文本和 runs ([[文本, 是否上标], ...])"""
+
+    def __init__(self, text, runs):
+        self.text = text
+        self.runs = runs
+
+
+def _run_text(r):
+    """与 python-docx 的 Run.text 相同"""
+    texts = []
+    for child in r:
+        if child.tag == W + 't':
+            texts.append(child.text or '')
+        elif child.tag in (W + 'tab', W + 'ptab'):
+            texts.append('\t')
+        elif child.tag == W + 'cr':
+            texts.append('\n')
+        elif child.tag == W + 'br':
+            texts.append('\n' if child.get(W + 'type', 'textWrapping') == 'textWrapping' else '')
+        elif child.tag == W + 'noBreakHyphen':
+            texts.append('-')
+    return ''.join(texts)
+
+
+def _run_superscript(r):
+    """与 python-docx 的 Run.font.superscript 相同"""
+    rpr = r.find(W + 'rPr')
+    if rpr is None:
+        return None
+    align = rpr.find(W + 'vertAlign')
+    if align is None:
+        return None
+    return align.get(W + 'val') == 'superscript'
+
+
+def iter_paragraphs(fname):
+    """
+    流式读取 word/document.xml 中正文的段落（不包括表格等里面的段落），
+    与 python-docx 的 Document(fname).paragraphs 相同
+    读完的段落随即释放，调用者不再需要时可以随时停止
+    """
+
+    with zipfile.ZipFile(fname) as zf, zf.open('word/document.xml') as fp:
+        body = None
+        depth = 0
+        for event, elem in ElementTree.iterparse(fp, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if depth == 2 and elem.tag == W + 'body':
+                    body = elem
+                continue
+            depth -= 1
+            # <w:document><w:body><w:p> 中 w:p 结束时 depth 为 2
+            if depth != 2 or body is None:
+                continue
+            if elem.tag == W + 'p':
+                texts = []
+                runs = []
+                for child in elem:
+                    if child.tag == W + 'r':
+                        text = _run_text(child)
+                        texts.append(text)
+                        runs.append([text, _run_superscript(child)])
+                    elif child.tag == W + 'hyperlink':
+                        texts.extend(_run_text(r) for r in child.findall(W + 'r'))
+                yield Paragraph(''.join(texts), runs)
+            body.remove(elem)
+
+
+def docx_paragraphs(fname):
+    """用 python-docx 读取段落"""
+    for paragraph in Document(fname).paragraphs:
+        yield Paragraph(paragraph.text, [[run.text, run.font.superscript] for run in paragraph.runs])
+
+
+def end_of_content(text):
+    """作者信息在空段落或者邮箱段落处结束"""
+    return text == '' or 'mail' in text.lower() or '@' in text
+
+
+# 摘要和关键字的标题，可以单独一段 ("Abstract:")，也可以和内容在同一段 ("Abstract—This paper ...")
+ABSTRACT_RE = re.compile(r'abstract(?:\s*[:：.—–-]\s*|\s*$)(.*)', re.I | re.S)
+KEYWORDS_RE = re.compile(r'(?:key\s*words?|index\s+terms)(?:\s*[:：.—–-]\s*|\s*$)(.*)', re.I | re.S)
+# 正文的第一个标题，没有关键字时在这里结束
+BODY_RE = re.compile(r'(?:(?:\d+|[IVX]+)\.?\s*)?(?:introduction|background)', re.I)
+# 没有找到摘要、关键字和正文时，最多读取的段落数
+MAX_FRONT_PARAGRAPHS = 100
+
+# 段落的类型
+TITLE = 'title'
+AUTHORS = 'authors'
+AFFILIATION = 'affiliation'
+EMAIL = 'email'
+ABSTRACT = 'abstract'
+KEYWORDS = 'keywords'
+BODY = 'body'
+LABEL = 'label'     # 单独一段的 "Abstract:"、"Keywords:"
+BLANK = 'blank'
+OTHER = 'other'
+
+
+def classify_front_matter(paragraphs):
+    """
+    按顺序给论文开头的段落分类，读到关键字（或者正文的第一个标题）后就停止，不读取正文
+    :param paragraphs: Paragraph 的迭代器
+    :return:           (段落序号, 类型, 内容, Paragraph) 的迭代器，
+                       内容是去掉 "Abstract—" 等标题后的文本
+    """
+
+    state = TITLE
+    for no, paragraph in enumerate(paragraphs):
+        text = paragraph.text
+        stripped = text.strip()
+        abstract = ABSTRACT_RE.fullmatch(stripped) if state not in (TITLE, KEYWORDS) else None
+        keywords = KEYWORDS_RE.fullmatch(stripped) if state not in (TITLE, KEYWORDS) else None
+
+        if keywords:
+            if keywords.group(1):
+                yield no, KEYWORDS, keywords.group(1), paragraph
+                return
+            yield no, LABEL, '', paragraph
+            state = KEYWORDS
+        elif abstract and state != ABSTRACT:
+            if abstract.group(1):
+                yield no, ABSTRACT, abstract.group(1), paragraph
+            else:
+                yield no, LABEL, '', paragraph
+            state = ABSTRACT
+        elif state in (TITLE, AUTHORS):
+            # 题目和作者前面的空段落跳过，可能还有空段落的作者行
+            if stripped == '':
+                yield no, BLANK, '', paragraph
+            else:
+                yield no, state, text, paragraph
+                state = AUTHORS if state == TITLE else AFFILIATION
+        elif state == AFFILIATION and not end_of_content(text):
+            yield no, AFFILIATION, text, paragraph
+        elif state in (AFFILIATION, EMAIL):
+            state = EMAIL
+            if BODY_RE.fullmatch(stripped):
+                yield no, BODY, text, paragraph
+                return
+            kind = BLANK if stripped == '' else EMAIL if end_of_content(text) else OTHER
+            yield no, kind, text, paragraph
+        elif state == ABSTRACT:
+            if BODY_RE.fullmatch(stripped):
+                yield no, BODY, text, paragraph
+                return
+            yield no, (ABSTRACT if stripped else BLANK), text, paragraph
+        elif state == KEYWORDS:
+            if stripped == '':
+                yield no, BLANK, '', paragraph
+                continue
+            yield no, KEYWORDS, text, paragraph
+            return
+        if no + 1 >= MAX_FRONT_PARAGRAPHS:
+            return
+
+
+def read_paper(fname, fast=True):
+    """
+    打开一次 fname，提取论文的所有信息
+    :param fast: 流式读取 word/document.xml，失败时再使用 python-docx
+    """
+
+    if fast:
+        try:
+            return parse_paper(fname, iter_paragraphs(fname))
+        except (KeyError, ElementTree.ParseError):
+            pass
+    return parse_paper(fname, docx_paragraphs(fname))
+
+
+def parse_paper(fname, paragraphs):
+    """
+    从段落中按顺序提取信息，读到关键字后就停止
+    :param paragraphs: Paragraph 的迭代器
+    """
+
+    pages, pages_source = count_pages(fname)
+    paper = Paper(fname, pages=pages, pages_source=pages_source)
+    abstract = []
+
+    with closing(paragraphs):
+        for no, kind, text, paragraph in classify_front_matter(paragraphs):
+            if kind == TITLE:
+                paper.title = text
+            elif kind == AUTHORS:
+                paper.authors = text
+                paper.front.append(paragraph.runs)
+            elif kind == AFFILIATION:
+                paper.affiliations.append(text)
+                paper.front.append(paragraph.runs)
+            elif kind == EMAIL and not paper.email:
+                paper.email = text
+            elif kind == ABSTRACT:
+                abstract.append(text)
+            elif kind == KEYWORDS:
+                paper.keywords = text
+                paper.body_start = no + 1
+            elif kind == BODY:
+                paper.body_start = no
+    paper.abstract = '\n'.join(abstract)
+    return paper
+
+
+def file_signature(fname):
+    stat = os.stat(fname)
+    return [stat.st_mtime, stat.st_size]
+
+
+class PaperCache:
+    """
+    论文信息的缓存
+    论文的修改时间和大小都没有改变时直接使用缓存，否则重新读取论文
+    每篇论文是数据库中的一行，读写一篇论文不需要把整个缓存载入内存
+    """
+
+    def __init__(self, path=CACHE_FILE):
+        self._path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS papers (path TEXT PRIMARY KEY, signature TEXT, paper TEXT)')
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != str(CACHE_VERSION):
+            self._db.execute('DELETE FROM papers')
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (str(CACHE_VERSION),))
+            self._db.commit()
+
+    def get(self, fname):
+        """获取论文 fname 的信息 (Paper)"""
+        return self.get_many([fname], jobs=1)[0]
+
+    def get_many(self, fnames, jobs=None):
+        """
+        获取多篇论文的信息，没有缓存的论文在多个进程中同时读取，读取后立即写入缓存
+        :param jobs: 进程数，默认为 CPU 核数
+        :return:     与 fnames 顺序相同的 Paper 列表
+        """
+
+        papers = {}
+        misses = {}
+        for fname in fnames:
+            key = os.path.abspath(fname)
+            signature = json.dumps(file_signature(fname))
+            row = self._db.execute('SELECT signature, paper FROM papers WHERE path = ?', (key,)).fetchone()
+            if row is None or row[0] != signature:
+                misses[key] = (fname, signature)
+            else:
+                papers[key] = Paper.from_dict(json.loads(row[1]))
+
+        names = [fname for fname, _ in misses.values()]
+        if len(names) > 1 and jobs != 1:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                read = list(executor.map(read_paper, names))
+        else:
+            read = [read_paper(fname) for fname in names]
+        for (key, (_, signature)), paper in zip(misses.items(), read):
+            papers[key] = paper
+            self._db.execute('INSERT OR REPLACE INTO papers VALUES (?, ?, ?)',
+                             (key, signature, json.dumps(paper.to_dict(), ensure_ascii=False)))
+        if misses:
+            self._db.commit()
+
+        result = []
+        for fname in fnames:
+            paper = papers[os.path.abspath(fname)]
+            paper.fname = fname
+            result.append(paper)
+        return result
+
+    def iter_many(self, fnames, jobs=None, chunksize=256):
+        """
+        与 get_many 相同，但每次只读取 chunksize 篇论文并按顺序返回，
+        调用者边读边写时，内存中只有当前这一批论文的信息
+        """
+
+        fnames = list(fnames)
+        for start in range(0, len(fnames), chunksize):
+            yield from self.get_many(fnames[start:start + chunksize], jobs)
+
+    def save(self):
+        """读取的论文已经在 get_many 中写入，这里只是确认提交"""
+        self._db.commit()
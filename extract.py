@@ -7,9 +7,15 @@ __doc__ = """
 __author__ = 'HeXi'
 
 import os
-import sys
+import re
 import shutil
+import csv
+import json
+import struct
 import zipfile
+import argparse
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from random import randint
 
 payment_keys = ['payment', '付款', '缴费', '支付', 'fee', 'receipt', '转账']
@@ -18,56 +24,201 @@ report_keys = ['report', 'plagiarism', 'plagrism', '查重']
 copyright_keys = ['copyright']
 other_keys = []
 
-def is_payment(fname):
-    base_name = os.path.splitext(fname)[0].lower()
-    ext = os.path.splitext(fname)[-1].lower()
-    exclude_keys = paper_keys + report_keys + copyright_keys + other_keys
-    if ext in ['.png', '.jpg', '.jpeg']:
-        return True
-    for key in exclude_keys:
-        if key in base_name:
+# 复制压缩包内文件时每次读写的字节数
+COPY_BUFSIZE = 1024 * 1024
+
+def _splitext(fname):
+    """与 os.path.splitext 结果相同，文件名中没有路径时更快"""
+    base, dot, ext = fname.rpartition('.')
+    if not dot or not base.strip('.') or '/' in ext or os.sep in ext:
+        return os.path.splitext(fname)
+    return base, dot + ext
+
+
+class FileClassifier:
+    """
+    文件名分类器
+    所有关键字在创建时编译成正则表达式：
+    classify 扫描一遍文件名就得到它包含的所有类别的关键字；
+    is_xxx 只需要判断是否包含某几类关键字，每次判断是一次 search
+    """
+
+    image_exts = ['.png', '.jpg', '.jpeg']
+
+    def __init__(self, categories):
+        """
+        :param categories: {类别: 关键字列表}，关键字都是小写
+        """
+
+        self._categories = {category: list(keys) for category, keys in categories.items()}
+        self._search = {}
+
+        # 同一位置可能匹配多个关键字时，它们一定互为前缀，
+        # 所以优先匹配最长的关键字，并把它所有前缀关键字的类别也算上
+        labels = {}
+        for category, keys in categories.items():
+            for key in keys:
+                labels.setdefault(key, set()).add(category)
+        self._labels = {
+            key: frozenset().union(*(cats for other, cats in labels.items() if key.startswith(other)))
+            for key in labels
+        }
+        self._pattern = re.compile('(?=({}))'.format(self._alternation(labels)))
+
+    @staticmethod
+    def _alternation(keys):
+        keys = sorted(keys, key=len, reverse=True)
+        return '|'.join(re.escape(key) for key in keys) if keys else '(?!)'
+
+    def _searcher(self, *categories):
+        """返回判断文件名是否包含 categories 中任意一个关键字的函数"""
+        try:
+            return self._search[categories]
+        except KeyError:
+            keys = [key for category in categories for key in self._categories.get(category, [])]
+            search = re.compile(self._alternation(set(keys))).search
+            self._search[categories] = search
+            return search
+
+    def classify(self, fname):
+        """
+        :return: (文件名（不含扩展名）包含的关键字的类别集合, 小写的扩展名)
+        """
+
+        base_name, ext = _splitext(fname)
+        found = set()
+        for key in self._pattern.findall(base_name.lower()):
+            found |= self._labels[key]
+        return found, ext.lower()
+
+    def is_payment(self, fname):
+        base_name, ext = _splitext(fname)
+        base_name = base_name.lower()
+        if ext.lower() in self.image_exts:
+            return True
+        if self._searcher('paper', 'report', 'copyright', 'other')(base_name):
+            return False
+        return self._searcher('payment')(base_name) is not None
+
+    def is_paper(self, fname, valid_exts=['.docx', '.doc', '.pdf'], invalid_exts=['.png', '.jpeg', 'jpg']):
+        base_name, ext = _splitext(fname)
+        base_name = base_name.lower()
+        ext = ext.lower()
+        # plagrism is the wrong spelling of plagiarism
+        if self._searcher('other', 'payment', 'report')(base_name):
             return False
-    for key in payment_keys:
-        if key in base_name:
+        if ext not in invalid_exts and self._searcher('paper')(base_name):
             return True
-    return False
+        return ext in valid_exts
+
+    def is_copyright(self, fname):
+        return self._searcher('copyright')(_splitext(fname)[0].lower()) is not None
+
+
+# 修改上面的关键字列表后需要重新创建分类器
+classifier = FileClassifier({
+    'payment': payment_keys,
+    'paper': paper_keys,
+    'report': report_keys,
+    'copyright': copyright_keys,
+    'other': other_keys,
+})
+
+
+def is_payment(fname):
+    return classifier.is_payment(fname)
 
 def is_camera(fname):
     return is_paper(fname, valid_exts=['.docx', '.doc'], invalid_exts=['.pdf', '.png', '.jpg', '.jpeg'])
 
 def is_paper(fname, valid_exts=['.docx', '.doc', '.pdf'], invalid_exts=['.png', '.jpeg', 'jpg']):
-    base_name = os.path.splitext(fname)[0].lower()
-    ext = os.path.splitext(fname)[-1].lower()
-    # plagrism is the wrong spelling of plagiarism
-    exclude_keys = other_keys + payment_keys + report_keys
-    for key in exclude_keys:
-        if key in base_name:
-            return False
-    for key in paper_keys:
-        if key in base_name and ext not in invalid_exts:
-            return True
-    if ext in valid_exts:
-        return True
-    return False
+    return classifier.is_paper(fname, valid_exts, invalid_exts)
 
 
 def is_copyright(fname):
-    stem_name = os.path.splitext(fname)[0].lower()
-    #ext = os.path.splitext(fname)[-1].lower()
-    return any(key in stem_name for key in copyright_keys)
+    return classifier.is_copyright(fname)
+
 
+# 各个模式对应的 (keep, unique) 参数
+# 对于提交的论文同时有word和pdf版本，一起提取出来
+# 终稿只提取 word 文档
+modes = {
+    'paper': (is_paper, False),
+    'payment': (is_payment, False),
+    'copyright': (is_copyright, True),
+    'camera': (is_camera, True),
+}
 
-def unzip(path, folderPath):
+
+def unzip(path, folderPath, keep=None, max_size=None):
     """
     解压文件
+    只根据压缩包的目录信息筛选，不需要的文件不会被解压
     :param path:       压缩文件路径
     :param folderPath: 解压后文件路径
+    :param keep:       只解压文件名满足 keep 条件的文件，默认全部解压
+    :param max_size:   跳过解压后超过 max_size 字节的文件
+    """
+
+    with zipfile.ZipFile(path) as zfile:
+        for zinfo in zfile.infolist():
+            if zinfo.is_dir():
+                continue
+            if keep and not keep(split_member(zinfo.filename)[1]):
+                continue
+            if too_large(zinfo, max_size):
+                continue
+            zfile.extract(zinfo, folderPath)
+
+
+def too_large(zinfo, max_size):
+    """解压后超过 max_size 字节时记录并返回 True"""
+    if max_size is None or zinfo.file_size <= max_size:
+        return False
+    print("too large ({} bytes)\t<-- {}".format(zinfo.file_size, zinfo.filename))
+    return True
+
+
+class NameIndex:
     """
+    id 到提取后文件名的索引
+    同一个 id 的第 n 个文件（从 0 开始）命名为 <id>-<n>，用计数器生成，不需要逐个尝试
+    CMT 的 id 都是数字，所以生成的名字不会和其他 id 冲突
+    """
+
+    def __init__(self):
+        self._files = {}
+
+    def __contains__(self, id_):
+        return id_ in self._files
 
-    zfile = zipfile.ZipFile(path)
-    files = zfile.namelist()
-    for f in files:
-        zfile.extract(f, folderPath)
+    def add(self, id_, ext):
+        """为 id_ 的下一个文件分配名字"""
+        files = self._files.setdefault(id_, [])
+        name = id_ if not files else "{}-{}".format(id_, len(files))
+        files.append(name + ext)
+        return name + ext
+
+    def items(self):
+        """[(id, [文件名, ...]), ...]，按照 id 第一次出现的顺序"""
+        return self._files.items()
+
+    def save(self, fname):
+        """保存为 CSV (id,file) 或者 JSON ({id: [file, ...]}) 文件，由扩展名决定"""
+        if fname.lower().endswith('.json'):
+            with open(fname, 'w', encoding='utf-8') as fp:
+                json.dump(self._files, fp, ensure_ascii=False, indent=1)
+            return
+        with open(fname, 'w', encoding='utf-8', newline='') as fp:
+            writer = csv.writer(fp)
+            writer.writerow(['id', 'file'])
+            for id_, files in self._files.items():
+                writer.writerows([id_, file] for file in files)
+
+
+def index_path(distance_zip):
+    """记录 distance_zip 中每个 id 对应哪些文件的索引文件"""
+    return distance_zip + '.index.csv'
 
 
 def filter_files(src, dst, keep=is_paper, unique=True):
@@ -77,31 +228,24 @@ def filter_files(src, dst, keep=is_paper, unique=True):
     <id>/[Submission]/<files>
     :param src: 所有文件根目录
     :param dst: 文件移动后的新目录
+    :return:    NameIndex
     """
 
-    ids = set()
+    index = NameIndex()
 
     for dirpath, dnames, fnames in os.walk(src):
         for fname in fnames:
-            path = os.path.join(dirpath, fname.replace('\\', os.path.sep))
-            id_ = path.split(os.path.sep)[1]
-            true_name = path.split(os.path.sep)[-1]
+            src2 = os.path.join(dirpath, fname)
+            id_, true_name = split_member(os.path.relpath(src2, src))
             ext = os.path.splitext(true_name)[-1].lower()
             if keep(true_name):
-                if id_ in ids and unique:
+                if id_ in index and unique:
                     continue
-                if id_ in ids:
-                    for i in range(1, 11):
-                        new_id = "{}-{}".format(id_, i)
-                        if new_id not in ids:
-                            id_ = new_id
-                            break
-                ids.add(id_)
                 # 移动文件
-                src2 = os.path.join(dirpath, fname)
-                dst2 = os.path.join(dst, id_ + ext)
+                dst2 = os.path.join(dst, index.add(id_, ext))
                 shutil.move(src2, dst2)
                 print("{}\t<-- {}".format(dst2, src2))
+    return index
 
 
 def compress_files(src, dstzip):
@@ -120,60 +264,438 @@ def compress_files(src, dstzip):
                 z.write(os.path.join(dirpath, filename), out_path + filename)
 
 
+def split_member(name):
+    """
+    从压缩包内的路径 <id>/[Submission]/<files> 中解析出 id 和文件名
+    CMT 导出的压缩包有时使用 '\\' 作为路径分隔符
+    :param name: 压缩包内的文件路径
+    :return:     (id, 文件名)
+    """
+
+    parts = [part for part in name.replace('\\', '/').split('/') if part]
+    return parts[0], parts[-1]
+
+
+def classify_members(zfile, rules, max_size=None):
+    """
+    只遍历一次压缩包的目录信息（文件名），同时按照多个规则选出需要保留的文件，
+    不解压任何内容。命名规则与 filter_files 相同，
+    但同一个 id 内 CRC 和大小都相同的重复文件只保留第一个
+    :param zfile:    打开的 zipfile.ZipFile 对象
+    :param rules:    {名称: (keep, unique)}，如 modes
+    :param max_size: 跳过解压后超过 max_size 字节的文件
+    :return:         ({名称: [(ZipInfo, 新文件名), ...]}, {名称: NameIndex})
+    """
+
+    indexes = {name: NameIndex() for name in rules}
+    selected = {name: [] for name in rules}
+    # 同一个 id 内已保留文件的 (CRC, 大小)，用于去掉重复上传的相同文件
+    contents = {name: {} for name in rules}
+
+    for zinfo in zfile.infolist():
+        if zinfo.is_dir():
+            continue
+        member_id, true_name = split_member(zinfo.filename)
+        ext = os.path.splitext(true_name)[-1].lower()
+        for name, (keep, unique) in rules.items():
+            if not keep(true_name):
+                continue
+            if too_large(zinfo, max_size):
+                break
+            content = (zinfo.CRC, zinfo.file_size)
+            kept = contents[name].setdefault(member_id, set())
+            if content in kept:
+                print("duplicate\t<-- {}".format(zinfo.filename))
+                continue
+            if member_id in indexes[name] and unique:
+                continue
+            kept.add(content)
+            selected[name].append((zinfo, indexes[name].add(member_id, ext)))
+    return selected, indexes
+
+
+def select_members(zfile, keep=is_paper, unique=True, max_size=None):
+    """
+    按照单个规则选出需要保留的文件
+    :param zfile: 打开的 zipfile.ZipFile 对象
+    :return:      ([(ZipInfo, 新文件名), ...], NameIndex)
+    """
+
+    selected, indexes = classify_members(zfile, {None: (keep, unique)}, max_size)
+    return selected[None], indexes[None]
+
+
+def copy_member(zfile, zinfo, dst, arcname, bufsize=COPY_BUFSIZE):
+    """
+    将 zfile 中的 zinfo 复制到 dst 压缩包中，并命名为 arcname
+    已经压缩（deflate 等）的文件直接复制原始数据，不解压也不重新压缩，
+    Python 不能解压的压缩方法（如 Windows 生成的 Deflate64）也可以复制；
+    未压缩的文件，或者不能直接复制原始数据时，以流的方式解压再压缩写入
+    每次只读写 bufsize 字节，占用的内存和文件大小无关
+    :param zfile:   源压缩包（zipfile.ZipFile）
+    :param zinfo:   源文件的 ZipInfo
+    :param dst:     以 'w' 或 'a' 模式打开的目标压缩包（zipfile.ZipFile）
+    :param arcname: 目标压缩包中的文件名
+    """
+
+    new_info = zipfile.ZipInfo(arcname, zinfo.date_time)
+    new_info.external_attr = zinfo.external_attr
+    raw = (zinfo.compress_type != zipfile.ZIP_STORED and not zinfo.flag_bits & 0x1
+           and zfile.filename is not None and _can_append_raw(dst))
+    if not raw:
+        new_info.compress_type = zipfile.ZIP_DEFLATED
+        with zfile.open(zinfo) as fsrc, dst.open(new_info, 'w', force_zip64=True) as fdst:
+            shutil.copyfileobj(fsrc, fdst, bufsize)
+        return
+
+    new_info.compress_type = zinfo.compress_type
+    new_info.CRC = zinfo.CRC
+    new_info.compress_size = zinfo.compress_size
+    new_info.file_size = zinfo.file_size
+    _append_raw(dst, new_info, _read_raw(zfile.filename, zinfo, bufsize))
+
+
+def _read_raw(path, zinfo, bufsize=COPY_BUFSIZE):
+    """
+    从压缩包 path 中按块读取 zinfo 的原始压缩数据，不创建解压器
+    数据在本地文件头之后，本地文件头是 30 字节加上其中记录的文件名和扩展字段的长度
+    """
+
+    with open(path, 'rb') as fp:
+        fp.seek(zinfo.header_offset)
+        header = fp.read(30)
+        if len(header) != 30 or header[:4] != b'PK\x03\x04':
+            raise zipfile.BadZipFile("Bad local file header: {}".format(zinfo.filename))
+        name_len, extra_len = struct.unpack('<HH', header[26:30])
+        fp.seek(name_len + extra_len, os.SEEK_CUR)
+        remain = zinfo.compress_size
+        while remain > 0:
+            data = fp.read(min(remain, bufsize))
+            if not data:
+                raise zipfile.BadZipFile("Truncated file: {}".format(zinfo.filename))
+            yield data
+            remain -= len(data)
+
+
+# zipfile 没有写入原始压缩数据的公开接口，_append_raw 和 ZipFile.write 一样维护这些内部属性
+_RAW_APPEND_ATTRS = ('fp', '_lock', '_seekable', '_didModify', 'filelist', 'NameToInfo', 'start_dir')
+
+
+def _can_append_raw(dst):
+    """dst 可以用 _append_raw 追加：zipfile 仍然有需要的内部属性，以写入模式打开并且可以 seek"""
+    return (all(hasattr(dst, attr) for attr in _RAW_APPEND_ATTRS)
+            and hasattr(zipfile.ZipInfo, 'FileHeader')
+            and dst.mode in ('w', 'x', 'a') and dst.fp is not None and dst._seekable
+            and not getattr(dst, '_writing', False))
+
+
+def _append_raw(dst, new_info, chunks):
+    """
+    把原始压缩数据 chunks 作为 new_info 追加到 dst 中，new_info 中已经设置了 CRC 和大小
+    写入本地文件头和数据，然后像 ZipFile.write 一样登记到中央目录，关闭 dst 时写出；
+    只在 _can_append_raw(dst) 为 True 时调用
+    """
+
+    with dst._lock:
+        zip64 = new_info.file_size > zipfile.ZIP64_LIMIT \
+                or new_info.compress_size > zipfile.ZIP64_LIMIT
+        if new_info.filename in dst.NameToInfo:
+            warnings.warn("Duplicate name: {!r}".format(new_info.filename), stacklevel=2)
+        dst.fp.seek(dst.start_dir)
+        new_info.header_offset = dst.fp.tell()
+        dst._didModify = True
+        dst.fp.write(new_info.FileHeader(zip64))
+        for data in chunks:
+            dst.fp.write(data)
+        dst.filelist.append(new_info)
+        dst.NameToInfo[new_info.filename] = new_info
+        dst.start_dir = dst.fp.tell()
+
+
+def manifest_path(distance_zip):
+    """增量提取时记录 distance_zip 中各文件来源的清单文件"""
+    return distance_zip + '.manifest.json'
+
+
+def manifest_entry(zinfo, arcname):
+    return {
+        'id': split_member(zinfo.filename)[0],
+        'member': zinfo.filename,
+        'crc': zinfo.CRC,
+        'size': zinfo.file_size,
+        'output': arcname,
+    }
+
+
+def _zip_stat(distance_zip):
+    stat = os.stat(distance_zip)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def read_manifest(distance_zip):
+    """
+    读取上次提取的清单，清单或者 distance_zip 不存在，
+    或者 distance_zip 在写清单之后被改变（大小、修改时间不同）时返回 None
+    :return: {新文件名: 清单记录}
+    """
+
+    path = manifest_path(distance_zip)
+    if not os.path.isfile(path) or not os.path.isfile(distance_zip):
+        return None
+    with open(path, encoding='utf-8') as fp:
+        manifest = json.load(fp)
+    # 旧版本的清单只有记录列表，无法确认 distance_zip 没有被改变
+    if not isinstance(manifest, dict) or manifest.get('zip') != _zip_stat(distance_zip):
+        return None
+    return {entry['output']: entry for entry in manifest['entries']}
+
+
+def write_manifest(distance_zip, entries):
+    """写入清单，同时记录 distance_zip 当前的大小和修改时间，需要在 distance_zip 写完之后调用"""
+    path = manifest_path(distance_zip)
+    with open(path + '.tmp', 'w', encoding='utf-8') as fp:
+        json.dump({'zip': _zip_stat(distance_zip), 'entries': entries}, fp, ensure_ascii=False, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def write_members(zin, members, distance_zip, incremental=False, bufsize=COPY_BUFSIZE):
+    """
+    将 zin 中选出的文件 members 写入 distance_zip
+    :param zin:         源压缩包（zipfile.ZipFile）
+    :param members:     [(ZipInfo 或压缩包内文件路径, 新文件名), ...]
+    :param incremental: 根据上次的清单只处理新增或者改变了的文件
+    """
+
+    members = [(zinfo if isinstance(zinfo, zipfile.ZipInfo) else zin.getinfo(zinfo), arcname)
+               for zinfo, arcname in members]
+    if incremental:
+        update_members(zin, members, distance_zip, bufsize)
+        return
+
+    with zipfile.ZipFile(distance_zip, 'w', zipfile.ZIP_DEFLATED) as zout:
+        for zinfo, arcname in members:
+            copy_member(zin, zinfo, zout, arcname, bufsize)
+            print("{}\t<-- {}".format(arcname, zinfo.filename))
+    # 覆盖了 distance_zip，同时更新清单，以免之后的增量提取使用旧的清单
+    write_manifest(distance_zip, [manifest_entry(zinfo, arcname) for zinfo, arcname in members])
+
+
+def update_members(zin, members, distance_zip, bufsize=COPY_BUFSIZE):
+    """
+    增量更新 distance_zip：
+    1. 和上次的清单完全相同时什么也不做
+    2. 只有新增的文件时，把新文件追加到 distance_zip 后面
+    3. 否则重新生成 distance_zip，没有改变的文件直接从上次的 distance_zip 中复制
+    """
+
+    entries = [manifest_entry(zinfo, arcname) for zinfo, arcname in members]
+    previous = read_manifest(distance_zip)
+    if previous is None:
+        previous = {}
+        unchanged = set()
+    else:
+        unchanged = {entry['output'] for entry in entries if previous.get(entry['output']) == entry}
+        if len(unchanged) == len(previous) == len(entries):
+            print("{} is up to date".format(distance_zip))
+            return
+
+    added = [(zinfo, arcname) for zinfo, arcname in members if arcname not in unchanged]
+    if previous and len(unchanged) == len(previous):
+        with zipfile.ZipFile(distance_zip, 'a', zipfile.ZIP_DEFLATED) as zout:
+            # 上次追加时中断会留下清单里没有的文件，这时只能重新生成
+            appendable = not any(arcname in zout.NameToInfo for _, arcname in added)
+            if appendable:
+                for zinfo, arcname in added:
+                    copy_member(zin, zinfo, zout, arcname, bufsize)
+                    print("{}\t<-- {}".format(arcname, zinfo.filename))
+        if appendable:
+            write_manifest(distance_zip, entries)
+            return
+
+    tmp_zip = distance_zip + '.tmp'
+    with zipfile.ZipFile(tmp_zip, 'w', zipfile.ZIP_DEFLATED) as zout:
+        zprev = zipfile.ZipFile(distance_zip) if unchanged else None
+        try:
+            for zinfo, arcname in members:
+                if arcname in unchanged and arcname in zprev.NameToInfo:
+                    copy_member(zprev, zprev.getinfo(arcname), zout, arcname, bufsize)
+                else:
+                    copy_member(zin, zinfo, zout, arcname, bufsize)
+                    print("{}\t<-- {}".format(arcname, zinfo.filename))
+        finally:
+            if zprev:
+                zprev.close()
+    os.replace(tmp_zip, distance_zip)
+    write_manifest(distance_zip, entries)
+
+
+def _write_members_job(source_zip, members, distance_zip, incremental=False, bufsize=COPY_BUFSIZE):
+    """在子进程中运行的 write_members，members 只包含文件路径以便传递"""
+    with zipfile.ZipFile(source_zip) as zin:
+        write_members(zin, members, distance_zip, incremental, bufsize)
+    return distance_zip
+
+
+def stream_extract(source_zip, distance_zip, keep=is_paper, unique=True, incremental=False,
+                   max_size=None, bufsize=COPY_BUFSIZE):
+    """
+    不使用临时目录，直接从 source_zip 中挑选出文件写入 distance_zip
+    :param source_zip:   CMT 下载的压缩文件
+    :param distance_zip: 提取结果的压缩文件
+    :param incremental:  根据上次的清单只处理新增或者改变了的文件
+    :param max_size:     跳过解压后超过 max_size 字节的文件
+    :param bufsize:      复制文件时每次读写的字节数
+    """
+
+    with zipfile.ZipFile(source_zip) as zin:
+        members, index = select_members(zin, keep, unique, max_size)
+        write_members(zin, members, distance_zip, incremental, bufsize)
+    index.save(index_path(distance_zip))
+
+
+def multi_extract(source_zip, distance_dir, mode_names, jobs=None, incremental=False,
+                  max_size=None, bufsize=COPY_BUFSIZE):
+    """
+    只读取一次 source_zip 的目录，同时提取多种文件，
+    每种文件在单独的进程中写入 distance_dir/<mode>.zip
+    :param source_zip:   CMT 下载的压缩文件
+    :param distance_dir: 保存提取结果的目录
+    :param mode_names:   需要提取的模式列表，如 ['paper', 'payment']
+    :param jobs:         进程数，默认为 CPU 核数
+    :param incremental:  根据上次的清单只处理新增或者改变了的文件
+    :param max_size:     跳过解压后超过 max_size 字节的文件
+    :param bufsize:      复制文件时每次读写的字节数
+    """
+
+    os.makedirs(distance_dir, exist_ok=True)
+    with zipfile.ZipFile(source_zip) as zin:
+        selected, indexes = classify_members(zin, {name: modes[name] for name in mode_names}, max_size)
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        for name, members in selected.items():
+            members = [(zinfo.filename, arcname) for zinfo, arcname in members]
+            distance_zip = os.path.join(distance_dir, name + '.zip')
+            indexes[name].save(index_path(distance_zip))
+            futures.append(executor.submit(_write_members_job, source_zip, members, distance_zip,
+                                           incremental, bufsize))
+        for future in as_completed(futures):
+            print("{} done".format(future.result()))
+
+
 def make_random_dir():
     dir_ = "{}.dir".format(randint(10000, 99999))
     os.mkdir(dir_)
     return dir_
 
 
-def usage():
-    print("extract.py [paper|payment|copyright|camera] {sources.zip} {destination.zip}")
-    print("e.g. extract.py paper Submission.zip papers.zip")
-
-
-def main():
+def parse_size(string):
+    """将 '512', '64K', '200M', '2G' 转换为字节数"""
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
+    string = string.strip().upper().rstrip('B')
+    try:
+        if string and string[-1] in units:
+            return int(float(string[:-1]) * units[string[-1]])
+        return int(string)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size: '{}'".format(string))
+
+
+def parse_modes(string):
+    """将 'paper,payment' 或 'all' 转换为模式列表"""
+    if string == 'all':
+        return list(modes)
+    names = [name.strip() for name in string.split(',') if name.strip()]
+    for name in names:
+        if name not in modes:
+            raise argparse.ArgumentTypeError("invalid mode: '{}' (choose from {})".format(
+                name, ', '.join(modes)))
+    return names
+
+
+def args_parser():
+    parser = argparse.ArgumentParser(description='从 CMT 下载的压缩文件提取论文或者其他文件')
+    parser.add_argument('mode',
+            nargs='?',
+            default=['paper'],
+            type=parse_modes,
+            help="提取的文件类型: {}，多个类型用 ',' 分隔，all 表示全部 (默认 paper)".format(
+                '|'.join(modes)))
+    parser.add_argument('source_zip', help="CMT 下载的压缩文件，如 Submission.zip")
+    parser.add_argument('distance_zip',
+            help="保存提取结果的压缩文件，如 papers.zip；"
+                 "提取多种文件时为保存结果的目录，每种文件保存为 <目录>/<mode>.zip")
+    parser.add_argument('-j', '--jobs',
+            type=int,
+            default=None,
+            help="同时提取多种文件时使用的进程数 (默认为 CPU 核数)")
+    parser.add_argument('-i', '--incremental',
+            action='store_true',
+            default=False,
+            help="增量提取：根据上次提取保存的清单 (<distance_zip>.manifest.json)，只处理新增或者改变了的文件")
+    parser.add_argument('--max-member-size',
+            type=parse_size,
+            default=None,
+            help="跳过解压后超过这个大小的文件，如 200M (默认不限制)")
+    parser.add_argument('--buffer-size',
+            type=parse_size,
+            default=COPY_BUFSIZE,
+            help="复制文件时每次读写的大小，如 64K (默认 1M)")
+    parser.add_argument('--legacy',
+            action='store_true',
+            default=False,
+            help="使用原来的 解压-过滤-压缩 流程（需要临时目录）")
+    return parser
+
+
+def legacy_extract(source_zip, distance_zip, keep=is_paper, unique=True, max_size=None):
     """
-    先从 sourcePath 路径解压文件到 extractDir
-    然后从 extractDir 提取最终文件并改名 放到 dstDir 中
-    再压缩 dstDir 文件夹中文件到 toFile
+    先从 source_zip 路径解压文件到 extract_dir
+    然后从 extract_dir 提取最终文件并改名 放到 distance_dir 中
+    再压缩 distance_dir 文件夹中文件到 distance_zip
     最后删除所有中间文件
     """
 
-    if len(sys.argv) < 3:
-        usage()
-        sys.exit(1)
-    elif len(sys.argv) == 3:
-        mode = 'paper'
-        source_zip = sys.argv[1]
-        distance_zip = sys.argv[2]
-    else:
-        mode = sys.argv[1]
-        source_zip = sys.argv[2]
-        distance_zip = sys.argv[3]
-
     extract_dir = make_random_dir()
-    unzip(source_zip, extract_dir)
+    unzip(source_zip, extract_dir, keep, max_size)
 
     distance_dir = make_random_dir()
-    # 对于提交的论文同时有word和pdf版本，一起提取出来
-    if 'paper' == mode:
-        filter_files(extract_dir, distance_dir, keep=is_paper, unique=False)
-    elif 'copyright' == mode:
-        filter_files(extract_dir, distance_dir, keep=is_copyright)
-    # 终稿只提取 word 文档
-    elif 'camera' == mode:
-        filter_files(extract_dir, distance_dir, keep=is_camera)
-    elif 'payment' == mode:
-        filter_files(extract_dir, distance_dir, keep=is_payment, unique=False)
-    else:
-        print("Invalid mode")
-        usage()
+    index = filter_files(extract_dir, distance_dir, keep=keep, unique=unique)
+    index.save(index_path(distance_zip))
 
     compress_files(distance_dir, distance_zip)
+    # 增量提取的清单不再对应 distance_zip
+    if os.path.isfile(manifest_path(distance_zip)):
+        os.remove(manifest_path(distance_zip))
 
     shutil.rmtree(extract_dir)
     shutil.rmtree(distance_dir)
 
 
+def main():
+    """
+    默认直接从 source_zip 中挑选文件写入 distance_zip，不产生中间文件
+    同时提取多种文件时只读取一次 source_zip，并行写入各个结果文件
+    """
+
+    args = args_parser().parse_args()
+    if len(args.mode) > 1 and args.legacy:
+        os.makedirs(args.distance_zip, exist_ok=True)
+        for name in args.mode:
+            keep, unique = modes[name]
+            legacy_extract(args.source_zip, os.path.join(args.distance_zip, name + '.zip'),
+                           keep, unique, args.max_member_size)
+    elif len(args.mode) > 1:
+        multi_extract(args.source_zip, args.distance_zip, args.mode, args.jobs, args.incremental,
+                      args.max_member_size, args.buffer_size)
+    elif args.legacy:
+        keep, unique = modes[args.mode[0]]
+        legacy_extract(args.source_zip, args.distance_zip, keep, unique, args.max_member_size)
+    else:
+        keep, unique = modes[args.mode[0]]
+        stream_extract(args.source_zip, args.distance_zip, keep, unique, args.incremental,
+                       args.max_member_size, args.buffer_size)
+
+
 if __name__ == '__main__':
     main()
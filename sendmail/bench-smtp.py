@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+import os
+import io
+import time
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import contextlib
+import socketserver
+
+from sendmail import Task
+
+__doc__ = """
+启动一个本地的 SMTP 服务器，用 thread 和 asyncio 两种方式发送同一个任务，
+比较每秒发送的邮件数、每个地址从第一次发送到被接受的时间 (p50/p99)、重试次数和每个账户发送的邮件数
+
+    $ ./bench-smtp.py -n 500 --latency 0.05 --reject 0.02 --connections 4
+"""
+
+
+class Handler(socketserver.StreamRequestHandler):
+    """
+    一个连接，只实现发送邮件需要的命令；DATA 结束后等待 latency 秒，以 reject 的概率返回 reject_code，
+    第一个账户被接受了 quota 封邮件后 MAIL 返回额度用完的 550，refuse_sender 时第一个账户的 MAIL 返回 553，
+    invalid 开头的地址 RCPT 返回 550
+    """
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        # 每个回复单独写入，关闭 Nagle 算法以免 PIPELINING 的回复被延迟
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with server.lock:
+            server.connections += 1
+        self.reply('220 bench ESMTP')
+        sent = 0
+        started, sender, rcpt = None, None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii', 'replace').strip()
+            verb = command[:4].upper()
+            if verb == 'EHLO':
+                extensions = ['AUTH PLAIN LOGIN'] + (['PIPELINING'] if server.pipelining else [])
+                self.reply('250-bench')
+                for extension in extensions[:-1]:
+                    self.reply('250-' + extension)
+                self.reply('250 ' + extensions[-1])
+            elif verb == 'HELO':
+                self.reply('250 bench')
+            elif verb == 'AUTH':
+                if command.upper().startswith('AUTH LOGIN'):
+                    self.reply('334 VXNlcm5hbWU6')
+                    self.rfile.readline()
+                    self.reply('334 UGFzc3dvcmQ6')
+                    self.rfile.readline()
+                self.reply('235 ok')
+            elif verb == 'MAIL':
+                if server.max_per_connection and sent >= server.max_per_connection:
+                    self.reply('421 too many messages')
+                    return
+                sender = command[command.find('<') + 1:command.rfind('>')]
+                if server.refuse_sender and sender == 'sender0@bench.local':
+                    started, rcpt = None, []
+                    self.reply('553 5.7.1 <{}>: Sender address rejected: not owned by user'.format(sender))
+                    continue
+                if server.quota and sender == 'sender0@bench.local' and server.sent_by.get(sender, 0) >= server.quota:
+                    started, rcpt = None, []
+                    self.reply('550 5.7.1 daily sending quota exceeded')
+                    continue
+                started, rcpt = time.perf_counter(), []
+                self.reply('250 ok')
+            elif verb == 'RCPT':
+                if started is None:
+                    self.reply('503 need MAIL command')
+                    continue
+                addr = command[command.find('<') + 1:command.rfind('>')]
+                if addr.startswith('invalid'):
+                    self.reply('550 5.1.1 <{}>: Recipient address rejected: User unknown'.format(addr))
+                    continue
+                rcpt.append(addr)
+                server.attempted(addr, started)
+                self.reply('250 ok')
+            elif verb == 'DATA':
+                if not rcpt:
+                    self.reply('554 no valid recipients')
+                    continue
+                self.reply('354 go ahead')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                time.sleep(server.latency)
+                if random.random() < server.reject:
+                    with server.lock:
+                        server.rejected += 1
+                    self.reply('{} try again later'.format(server.reject_code))
+                    if server.reject_code == 421:
+                        return
+                else:
+                    sent += 1
+                    server.accepted(sender, rcpt, started)
+                    self.reply('250 queued')
+                started, rcpt = None, []
+            elif verb == 'RSET':
+                started, rcpt = None, []
+                self.reply('250 ok')
+            elif verb == 'NOOP':
+                self.reply('250 ok')
+            elif verb == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('502 unknown command')
+
+
+class Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, latency, reject, reject_code, quota, pipelining, max_per_connection, refuse_sender=False):
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.latency = latency
+        self.reject = reject
+        self.reject_code = reject_code
+        self.quota = quota
+        self.pipelining = pipelining
+        self.max_per_connection = max_per_connection
+        self.refuse_sender = refuse_sender
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.connections = 0
+            self.rejected = 0
+            self.first_seen = {}    # 地址第一次发送 MAIL 的时间
+            self.latencies = []     # 每个地址从第一次发送到被接受的时间
+            self.duplicated = 0
+            self.sent_by = {}       # 每个发送者被接受的邮件数
+
+    def accepted(self, sender, rcpt, started):
+        now = time.perf_counter()
+        with self.lock:
+            self.sent_by[sender] = self.sent_by.get(sender, 0) + 1
+            for addr in rcpt:
+                if addr in self.first_seen and self.first_seen[addr] is None:
+                    self.duplicated += 1
+                    continue
+                self.latencies.append(now - (self.first_seen.get(addr) or started))
+                self.first_seen[addr] = None
+
+    def attempted(self, addr, started):
+        with self.lock:
+            self.first_seen.setdefault(addr, started)
+
+
+def _percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def write_task(path, port, args):
+    """在 path 下生成有 args.messages 个地址、args.accounts 个账户的任务"""
+    with open(os.path.join(path, 'address.txt'), 'w') as fp:
+        fp.write('\n'.join(['user{}@bench.local'.format(i) for i in range(args.messages)]
+                            + ['invalid{}@bench.local'.format(i) for i in range(args.invalid)]))
+    with open(os.path.join(path, 'context.txt'), 'w') as fp:
+        fp.write('bench\n')
+    with open(os.path.join(path, 'attach.bin'), 'wb') as fp:
+        fp.write(os.urandom(args.attach_size))
+    accounts = ',\n'.join(
+        "    dict(sender='sender{0}@bench.local', user='sender{0}', password='p', "
+        "smtp_server='127.0.0.1', smtp_port={1}, per_minute={2}, connections={3}, retry_wait={4})".format(
+            i, port, args.per_minute or None, args.connections, args.retry_wait)
+        for i in range(args.accounts))
+    with open(os.path.join(path, 'task.py'), 'w') as fp:
+        fp.write("email = {{'from': 'Bench <bench@bench.local>', 'reply-to': None, 'subject': 'bench',\n"
+                 "         'context': '@context.txt', 'attaches': ['attach.bin']}}\n"
+                 "accounts = [\n{}\n]\n"
+                 "address = ['@address.txt']\n".format(accounts))
+
+
+def bench(backend, server, args):
+    server.reset()
+    with tempfile.TemporaryDirectory() as path:
+        write_task(path, server.server_address[1], args)
+        task = Task(Task.load_config(path), path)
+        log = io.StringIO()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(log):
+            task.run(backend)
+        elapsed = time.perf_counter() - start
+    latencies = server.latencies
+    print('{:8} {:>6} {:>8.1f} {:>9.1f} {:>9.1f} {:>8} {:>6} {:>6}  {}'.format(
+        backend, len(latencies), len(latencies) / elapsed,
+        _percentile(latencies, 50) * 1000, _percentile(latencies, 99) * 1000,
+        server.rejected, server.duplicated, server.connections,
+        ' '.join(str(cnt) for _, cnt in sorted(server.sent_by.items()))))
+
+
+def args_parser():
+    parser = argparse.ArgumentParser(description='在本地 SMTP 服务器上比较 thread 和 asyncio 两种发送方式')
+    parser.add_argument('-b', '--backend', choices=['thread', 'asyncio'], action='append',
+            help="测试的发送方式，可以多次指定 (默认两种都测试)")
+    parser.add_argument('-n', '--messages', type=int, default=200, help="邮件数 (默认 200)")
+    parser.add_argument('--accounts', type=int, default=2, help="账户数 (默认 2)")
+    parser.add_argument('--connections', type=int, default=2, help="每个账户的连接数 (默认 2)")
+    parser.add_argument('--per-minute', type=float, default=0, help="每个账户每分钟发送的邮件数 (默认 0 不限制)")
+    parser.add_argument('--retry-wait', type=float, default=0.1, help="发送失败后等待的秒数 (默认 0.1)")
+    parser.add_argument('--latency', type=float, default=0.02, help="服务器接收每封邮件的时间 (默认 0.02 秒)")
+    parser.add_argument('--reject', type=float, default=0, help="服务器暂时拒绝邮件的概率 (默认 0)")
+    parser.add_argument('--reject-code', type=int, choices=[421, 450, 451], default=451,
+            help="服务器暂时拒绝邮件的回复码 (默认 451)")
+    parser.add_argument('--quota', type=int, default=0,
+            help="第一个账户被接受这么多封邮件后，服务器返回额度用完的 550，其他账户继续发送 (默认 0 不限制)")
+    parser.add_argument('--max-per-connection', type=int, default=0,
+            help="服务器每个连接接受的邮件数，超过后返回 421 (默认 0 不限制)")
+    parser.add_argument('--refuse-sender', action='store_true',
+            help="服务器用 553 拒绝第一个账户的发送者地址，其他账户继续发送")
+    parser.add_argument('--invalid', type=int, default=0,
+            help="另外发送给这么多个不存在的地址，服务器返回 550 (默认 0)")
+    parser.add_argument('--no-pipelining', action='store_true', help="服务器不支持 PIPELINING")
+    parser.add_argument('--attach-size', type=int, default=64*1024, help="附件大小 (默认 64KiB)")
+    return parser.parse_args()
+
+
+def main():
+    args = args_parser()
+    server = Server(args.latency, args.reject, args.reject_code, args.quota,
+                    not args.no_pipelining, args.max_per_connection, args.refuse_sender)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('{:8} {:>6} {:>8} {:>9} {:>9} {:>8} {:>6} {:>6}  {}'.format(
+        'backend', 'sent', 'msgs/s', 'p50(ms)', 'p99(ms)', 'retries', 'dup', 'conns', 'per account'))
+    try:
+        for backend in args.backend or ['thread', 'asyncio']:
+            bench(backend, server, args)
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
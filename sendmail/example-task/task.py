@@ -6,6 +6,8 @@ email = {
     # 邮件标题
     'subject': 'Subject of this Email',
     # 邮件内容，@开头表示内容从文件里读取，否则使用字符串内容作为邮件内容
+    # 地址来自 CSV/JSONL 文件时，标题和内容是模板，可以使用文件中的变量，如 $name、${paper_id}，
+    # $email 为收件人地址，$$ 表示 $；否则按原样发送。可以用 'template': True/False 指定是否使用模板
     'context': '@email-context.txt',
     # 附件列表
     'attaches': ['big-picture.png', 'paper.pdf']
@@ -23,6 +25,15 @@ accounts = [
         # smtp 服务器地址和端口，这是本校的教师的邮箱服务器地址
         'smtp_server': 'mail.uestc.edu.cn',
         'smtp_port': 25,
+        # 可选，这个账户同时打开的连接数，默认 1
+        'connections': 1,
+        # 可选，这个账户每分钟最多发送的邮件数，None 表示不限制，默认每个连接每秒 1 封
+        'per_minute': 60,
+        # 可选，这个账户每天最多发送的邮件数，默认不限制
+        'per_day': 1000,
+        # 可选，服务器暂时拒绝后暂停的秒数，默认 60 秒，之后每次加倍，最多 max_retry_wait 秒 (默认 3600)
+        'retry_wait': 60,
+        'max_retry_wait': 3600,
     },
 
     # 另一个发送者信息
@@ -40,6 +51,9 @@ address = [
     # @开头表示从文件读取邮箱列表
     '@address-list.txt',
     '@address-list2.txt',
+    # .csv (第一行是表头) 或 .jsonl (每行一个 JSON 对象) 文件，必须有 email 列，其他列作为模板变量
+    # 同一个 email 的多行 (如多篇论文) 每行发送一封，新的行添加在文件最后
+    '@address-list.csv',
     #一个邮箱地址
     'address@example.com',
     'email@email.com',
@@ -2,13 +2,22 @@
 
 import re
 import os
+import csv
+import json
+import time
+import base64
+import random
+import signal
+import socket
+import asyncio
 import smtplib
 import mimetypes
 import argparse
+import threading
 import importlib.util
+from string import Template
 from collections import deque
-from time import sleep
-from contextlib import closing
+from datetime import datetime, timedelta
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.utils import formataddr
@@ -31,19 +40,54 @@ def _parse_and_read(string, mode='r', prefix='@'):
     return _cat(string.lstrip(prefix), mode)
 
 
+class TextTemplate:
+    """
+    string.Template 格式的模板 ($name 或 ${name})，创建时只解析一次，每次渲染只是拼接字符串
+    $$ 输出 $，不是变量的 $ (如 $5) 按原样输出
+    """
+
+    def __init__(self, template):
+        self._parts = []    # [文本, 变量名, 文本, ..., 变量名, 文本]
+        literal, last = [], 0
+        for m in Template.pattern.finditer(template):
+            literal.append(template[last:m.start()])
+            last = m.end()
+            name = m.group('named') or m.group('braced')
+            if name is None:
+                literal.append(m.group() if m.group('escaped') is None else Template.delimiter)
+                continue
+            self._parts += [''.join(literal), name]
+            literal = []
+        literal.append(template[last:])
+        self._parts.append(''.join(literal))
+        self.names = set(self._parts[1::2])
+
+    def render(self, fields):
+        if not self.names:
+            return self._parts[0]
+        parts = self._parts[:]
+        parts[1::2] = [str(fields[name]) for name in self._parts[1::2]]
+        return ''.join(parts)
+
+
 class Message:
-    """邮件正文内容"""
-    def __init__(self, from_, subject, context, attaches=None, reply_to=None):
+    """
+    邮件正文内容
+    附件在创建时只编码一次，保存为字节；template 为 True 时标题和正文是 TextTemplate 模板，
+    每个收件人的邮件只渲染标题、正文并编码正文，加上自己的 To 头部，其余部分共用；
+    否则标题和正文按原样发送，其中的 $ 不做任何处理
+    """
+    def __init__(self, from_, subject, context, attaches=None, reply_to=None, template=False):
         sender_info = re.match(r'\s*(.+?)\s*<([-_\w.]+@[-_\w.]+\.\w+)>', from_)
         sender_name = sender_info[1]
         sender_addr = sender_info[2]
         message = MIMEMultipart()
         message['From'] = formataddr([sender_name, sender_addr])
-        message['Subject'] = Header(subject)
         message['Reply-To'] = reply_to if reply_to else sender_addr
 
-        # 正文
-        message.attach(MIMEText(context, 'plain', 'utf-8'))
+        # 正文，先用没有内容的部分生成邮件，再从邮件中把它分出来
+        text = MIMEText('', 'plain', 'utf-8')
+        message.attach(text)
 
         # 附件
         attaches = attaches or []
@@ -54,57 +98,588 @@ class Message:
             attach['Content-Disposition'] = 'attachment; filename="{}"'.format(os.path.basename(attach_path))
             message.attach(attach)
 
-        self._message = message
+        # smtplib 发送 bytes 时不转换换行符，直接生成 CRLF 换行的邮件
+        policy = message.policy.clone(linesep='\r\n')
+        data = message.as_bytes(policy=policy)
+        if not data.endswith(b'\r\n'):
+            data += b'\r\n'
+        headers, body = data.split(b'\r\n\r\n', 1)
+        text_head = text.as_bytes(policy=policy)
+        before_text, after_text = (b'\r\n' + body).split(text_head, 1)
+        # 每一块都从一行的开头开始，分别转义以 . 开头的行 (SMTP 的 dot-stuffing)，
+        # 发送时不再转义整封邮件；正文是 base64 编码，不会以 . 开头
+        self._headers = Message._quote_periods(headers + b'\r\n')
+        self._before_text = Message._quote_periods(before_text + text_head)
+        self._after_text = Message._quote_periods(after_text)
 
+        self.names = set()      # 模板中的变量
+        if template:
+            self._subject = TextTemplate(subject)
+            self._context = TextTemplate(context)
+            self.names = self._subject.names | self._context.names
+            if not self.names:
+                # 没有变量的模板只需要把 $$ 换成 $
+                subject, context = self._subject.render({}), self._context.render({})
+        if not self.names:
+            self._subject_header = Message._header('Subject', subject)
+            self._text = Message._encode(context)
 
-    def to(self, to_addr):
-        try:
-            self._message.replace_header('To', to_addr)
-        except KeyError:
-            self._message.add_header('To', to_addr)
-        return self
 
-    def as_string(self):
-        return self._message.as_string()
+    def render(self, to_addr, fields=None):
+        """
+        收件人为 to_addr 的邮件内容 (bytes)，可以在多个线程中同时调用
+        以 . 开头的行已经转义，以 CRLF 结束，直接在 DATA 后发送，再加上结束的 '.\\r\\n'
+        :param fields: 这个收件人的模板变量，模板中的 $email 为 to_addr
+        """
+        if self.names:
+            fields = dict(fields or {}, email=to_addr)
+            subject = Message._header('Subject', self._subject.render(fields))
+            text = Message._encode(self._context.render(fields))
+        else:
+            subject, text = self._subject_header, self._text
+        return b''.join([self._headers, subject, Message._header('To', to_addr),
+                         self._before_text, text, self._after_text])
+
+    @staticmethod
+    def _quote_periods(data):
+        return re.sub(br'(?m)^\.', b'..', data)
+
+    @staticmethod
+    def _encode(text):
+        """与 MIMEText(text, 'plain', 'utf-8') 相同的 base64 编码"""
+        return base64.encodebytes(text.encode('utf-8')).replace(b'\n', b'\r\n')
+
+    @staticmethod
+    def _header(name, value):
+        """
+        一行头部；模板变量 (如 CSV 中多行的 title) 中的换行换成空格，不会插入新的头部
+        """
+        value = re.sub(r'\s*[\r\n]+\s*', ' ', value).strip()
+        if not value.isascii():
+            value = Header(value, 'utf-8').encode(linesep='\r\n')
+        return '{}: {}\r\n'.format(name, value).encode('ascii')
+
+
+class Session(smtplib.SMTP):
+    """一个登录后的 SMTP 连接，服务器支持 PIPELINING 时一次发送 MAIL、RCPT 和 DATA 命令"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sent = 0       # 这个连接已经发送的邮件数
+
+    def sendmail(self, from_addr, to_addr, msg):
+        """
+        发送一封邮件给一个收件人
+        msg 为 Message.render 的结果，已经转义了以 . 开头的行，发送时不再逐字节处理整封邮件
+        """
+        self.ehlo_or_helo_if_needed()
+        commands = ['MAIL FROM:{}'.format(smtplib.quoteaddr(from_addr)),
+                    'RCPT TO:{}'.format(smtplib.quoteaddr(to_addr)),
+                    'DATA']
+        if self.has_extn('pipelining'):
+            self.send(''.join(command + '\r\n' for command in commands))
+            replies = [self.getreply() for _ in commands]
+        else:
+            # 一条命令失败后不再发送后面的命令
+            replies = []
+            for command, ok in zip(commands, [(250,), (250, 251), (354,)]):
+                replies.append(self.docmd(command))
+                if replies[-1][0] not in ok:
+                    break
+        if any(code == 421 for code, _ in replies):
+            self.close()
+            code, resp = next(reply for reply in replies if reply[0] == 421)
+            raise smtplib.SMTPResponseException(code, resp)
+
+        (mail_code, mail_resp), (rcpt_code, rcpt_resp), (data_code, data_resp) = \
+            (replies + [(-1, b'')] * 3)[:3]
+        if data_code == 354 and (mail_code != 250 or rcpt_code not in (250, 251)):
+            # 服务器接受了 DATA，发送空的邮件结束这次会话
+            self.send(b'.' + smtplib.bCRLF)
+            self.getreply()
+        if mail_code != 250:
+            self._rset()
+            raise smtplib.SMTPSenderRefused(mail_code, mail_resp, from_addr)
+        if rcpt_code not in (250, 251):
+            self._rset()
+            raise smtplib.SMTPRecipientsRefused({to_addr: (rcpt_code, rcpt_resp)})
+        if data_code != 354:
+            self._rset()
+            raise smtplib.SMTPDataError(data_code, data_resp)
+
+        self.send(msg + b'.' + smtplib.bCRLF)
+        code, resp = self.getreply()
+        if code == 421:
+            self.close()
+            raise smtplib.SMTPResponseException(code, resp)
+        if code != 250:
+            self._rset()
+            raise smtplib.SMTPDataError(code, resp)
 
 
 class Smtp:
-    def __init__(self, account):
-        self._account = account
-        self._emails_per_connection = 5
-        self._emails_on_connection = 0
-        self._closed = True
+    """
+    一个账户的 SMTP 连接池，可以在多个线程中同时使用
+    登录后的连接发送完后放回池中继续使用，再次使用前用 NOOP 检查；同时最多打开
+    account['connections'] (默认 1) 个连接
 
-    def _login(self):
-        self._smtp = smtplib.SMTP(self._account['smtp_server'], self._account['smtp_port'])
-        self._smtp.login(self._account['user'], self._account['password'])
-        self._closed = False
+    每个连接发送的邮件数没有固定的上限：服务器在一个连接发送了 n 封邮件后断开或者返回 421 时，
+    以 n 作为上限，之后的连接发送 n 封后主动重新连接；按照上限正常重连 _probe_after 次后上限加 1
+    """
 
-    def _relogin(self):
-        self.close()
-        self._login()
+    _probe_after = 10
+    timeout = 60        # 连接和等待服务器回复的超时秒数，服务器没有响应时不会一直等待
+
+    def __init__(self, account):
+        self._account = account
+        self.connections = account.get('connections', 1)
+        self._emails_per_connection = None  # 每个连接发送的邮件数上限，None 表示还没有遇到上限
+        self._recycled = 0                  # 按照上限主动重新连接的次数
+        self._idle = []                     # 空闲的连接
+        self._opened = 0                    # 打开的连接数，包括正在使用的
+        self._cond = threading.Condition()
 
     @property
     def sender(self):
         return self._account['sender']
 
+    def _login(self):
+        smtp = Session(self._account['smtp_server'], self._account['smtp_port'], timeout=self.timeout)
+        try:
+            smtp.login(self._account['user'], self._account['password'])
+        except Exception:
+            smtp.close()
+            raise
+        return smtp
+
+    def _exhausted(self, smtp):
+        return self._emails_per_connection is not None and smtp.sent >= self._emails_per_connection
+
+    def _acquire(self):
+        """取出一个可用的连接，没有空闲的连接并且已经打开了 connections 个连接时等待"""
+        while True:
+            with self._cond:
+                while not self._idle and self._opened >= self.connections:
+                    self._cond.wait()
+                smtp = self._idle.pop() if self._idle else None
+                if smtp is None:
+                    self._opened += 1
+            if smtp is None:
+                try:
+                    return self._login()
+                except Exception:
+                    self._discard(None)
+                    raise
+            if self._exhausted(smtp):
+                self._recycle()
+            else:
+                try:
+                    if smtp.noop()[0] == 250:
+                        return smtp
+                except (smtplib.SMTPException, OSError):
+                    pass
+            self._discard(smtp)
+
+    def _release(self, smtp):
+        with self._cond:
+            self._idle.append(smtp)
+            self._cond.notify()
+
+    def _discard(self, smtp):
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                smtp.close()
+        with self._cond:
+            self._opened -= 1
+            self._cond.notify()
+
+    def _recycle(self):
+        """按照上限主动重新连接，连续 _probe_after 次后尝试放宽上限"""
+        with self._cond:
+            self._recycled += 1
+            if self._recycled >= self._probe_after:
+                self._recycled = 0
+                self._emails_per_connection += 1
+
+    def _limited(self, smtp):
+        """服务器在发送了 smtp.sent 封邮件后断开了连接，以此作为上限"""
+        if smtp.sent == 0:
+            return
+        with self._cond:
+            if self._emails_per_connection is None or smtp.sent < self._emails_per_connection:
+                self._emails_per_connection = smtp.sent
+            self._recycled = 0
+
     def sendmail(self, to_addr, msg):
-        if self._closed:
-            self._login()
-        if self._emails_on_connection >= self._emails_per_connection:
-            self._relogin()
-        self._emails_on_connection += 1
+        """
+        发送一封邮件
+        已经发送过邮件的连接被服务器断开时，记录上限后用新的连接重试一次
+        """
+
+        while True:
+            smtp = self._acquire()
+            try:
+                smtp.sendmail(self.sender, to_addr, msg)
+            except smtplib.SMTPRecipientsRefused:
+                # 只是地址被拒绝，连接还可以继续使用
+                self._release(smtp)
+                raise
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException) as e:
+                self._discard(smtp)
+                if isinstance(e, smtplib.SMTPServerDisconnected) or e.smtp_code == 421:
+                    if smtp.sent > 0:
+                        self._limited(smtp)
+                        continue
+                raise
+            except Exception:
+                self._discard(smtp)
+                raise
+            smtp.sent += 1
+            self._release(smtp)
+            return
+
+    def close(self):
+        """关闭所有空闲的连接"""
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for smtp in idle:
+            self._discard(smtp)
+
+
+class AsyncSession:
+    """
+    asyncio 的 SMTP 连接，和 Session 一样登录后发送，服务器支持 PIPELINING 时一次发送
+    MAIL、RCPT 和 DATA 命令；出错时抛出和 smtplib 相同的异常
+    """
+
+    def __init__(self, host, port, local_hostname, timeout=60):
+        self._host = host
+        self._port = port
+        self._local_hostname = local_hostname
+        self._timeout = timeout
+        self._reader = None
+        self._writer = None
+        self._extns = {}
+        self.sent = 0       # 这个连接已经发送的邮件数
+
+    async def connect(self):
+        """连接服务器并发送 EHLO（不支持时 HELO）"""
+        self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self._host, self._port), self._timeout)
+        code, resp = await self.getreply()
+        if code != 220:
+            self.close()
+            raise smtplib.SMTPConnectError(code, resp)
+        code, resp = await self.docmd('EHLO ' + self._local_hostname)
+        if code == 250:
+            # 与 smtplib.SMTP.ehlo 相同，第一行之后每行是一个扩展
+            for line in resp.decode('latin-1').split('\n')[1:]:
+                m = re.match(r'(?P<feature>[A-Za-z0-9][A-Za-z0-9\-]*) ?', line)
+                if m:
+                    self._extns[m.group('feature').lower()] = line[m.end('feature'):].strip()
+            return
+        code, resp = await self.docmd('HELO ' + self._local_hostname)
+        if code != 250:
+            self.close()
+            raise smtplib.SMTPHeloError(code, resp)
+
+    def has_extn(self, name):
+        return name.lower() in self._extns
+
+    async def send(self, data):
+        if self._writer is None:
+            raise smtplib.SMTPServerDisconnected('please run connect() first')
+        if isinstance(data, str):
+            data = data.encode('ascii')
+        try:
+            self._writer.write(data)
+            await self._writer.drain()
+        except OSError:
+            self.close()
+            raise smtplib.SMTPServerDisconnected('Server not connected')
+
+    async def getreply(self):
+        """读取服务器的一个回复，多行回复的内容用 '\\n' 连接"""
+        if self._reader is None:
+            raise smtplib.SMTPServerDisconnected('please run connect() first')
+        lines = []
+        while True:
+            try:
+                line = await asyncio.wait_for(self._reader.readline(), self._timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                self.close()
+                raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed: ' + str(e))
+            if not line:
+                self.close()
+                raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+            lines.append(line[4:].strip(b' \t\r\n'))
+            if line[3:4] != b'-':
+                break
+        try:
+            code = int(line[:3])
+        except ValueError:
+            code = -1
+        return code, b'\n'.join(lines)
+
+    async def docmd(self, command):
+        await self.send(command + '\r\n')
+        return await self.getreply()
+
+    async def login(self, user, password):
+        """AUTH PLAIN 或 AUTH LOGIN 登录"""
+        methods = self._extns.get('auth', '').upper().split()
+        if not methods:
+            raise smtplib.SMTPNotSupportedError('SMTP AUTH extension not supported by server.')
+
+        def b64(text):
+            return base64.b64encode(text.encode('utf-8')).decode('ascii')
+
+        if 'PLAIN' in methods:
+            code, resp = await self.docmd('AUTH PLAIN ' + b64('\0{}\0{}'.format(user, password)))
+        elif 'LOGIN' in methods:
+            code, resp = await self.docmd('AUTH LOGIN ' + b64(user))
+            if code == 334:
+                code, resp = await self.docmd(b64(password))
+        else:
+            raise smtplib.SMTPException('No suitable authentication method found.')
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, resp)
+
+    async def noop(self):
+        return await self.docmd('NOOP')
+
+    async def _rset(self):
         try:
-            self._smtp.sendmail(self.sender, to_addr, msg)
-        except smtplib.SMTPResponseException as e:
-            self._emails_on_connection += 1
+            await self.docmd('RSET')
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+    async def sendmail(self, from_addr, to_addr, msg):
+        """同 Session.sendmail"""
+        commands = ['MAIL FROM:{}'.format(smtplib.quoteaddr(from_addr)),
+                    'RCPT TO:{}'.format(smtplib.quoteaddr(to_addr)),
+                    'DATA']
+        if self.has_extn('pipelining'):
+            await self.send(''.join(command + '\r\n' for command in commands))
+            replies = [await self.getreply() for _ in commands]
+        else:
+            # 一条命令失败后不再发送后面的命令
+            replies = []
+            for command, ok in zip(commands, [(250,), (250, 251), (354,)]):
+                replies.append(await self.docmd(command))
+                if replies[-1][0] not in ok:
+                    break
+        if any(code == 421 for code, _ in replies):
+            self.close()
+            code, resp = next(reply for reply in replies if reply[0] == 421)
+            raise smtplib.SMTPResponseException(code, resp)
+
+        (mail_code, mail_resp), (rcpt_code, rcpt_resp), (data_code, data_resp) = \
+            (replies + [(-1, b'')] * 3)[:3]
+        if data_code == 354 and (mail_code != 250 or rcpt_code not in (250, 251)):
+            # 服务器接受了 DATA，发送空的邮件结束这次会话
+            await self.send(b'.\r\n')
+            await self.getreply()
+        if mail_code != 250:
+            await self._rset()
+            raise smtplib.SMTPSenderRefused(mail_code, mail_resp, from_addr)
+        if rcpt_code not in (250, 251):
+            await self._rset()
+            raise smtplib.SMTPRecipientsRefused({to_addr: (rcpt_code, rcpt_resp)})
+        if data_code != 354:
+            await self._rset()
+            raise smtplib.SMTPDataError(data_code, data_resp)
+
+        await self.send(msg + b'.' + smtplib.bCRLF)
+        code, resp = await self.getreply()
+        if code == 421:
+            self.close()
+            raise smtplib.SMTPResponseException(code, resp)
+        if code != 250:
+            await self._rset()
+            raise smtplib.SMTPDataError(code, resp)
+
+    async def quit(self):
+        try:
+            await self.docmd('QUIT')
+        finally:
             self.close()
-            raise e
 
     def close(self):
-        if not self._closed:
-            self._smtp.close()
-        self._closed = True
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+
+class AsyncSmtp(Smtp):
+    """
+    Smtp 连接池的 asyncio 版本，只能在一个事件循环中使用
+    同时最多 connections 个协程在发送，每封邮件的上限和 Smtp 一样自动调整
+    """
+
+    def __init__(self, account):
+        super().__init__(account)
+        self._slots = asyncio.Semaphore(self.connections)
+        self._local_hostname = socket.getfqdn()
+
+    async def _login(self):
+        smtp = AsyncSession(self._account['smtp_server'], self._account['smtp_port'],
+                            self._local_hostname, self.timeout)
+        try:
+            await smtp.connect()
+            await smtp.login(self._account['user'], self._account['password'])
+        except BaseException:
+            smtp.close()
+            raise
+        return smtp
+
+    @staticmethod
+    async def _quit(smtp):
+        try:
+            await smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+
+    async def _acquire(self):
+        """取出一个可用的连接，已经有 connections 个协程在发送时等待"""
+        await self._slots.acquire()
+        while self._idle:
+            smtp = self._idle.pop()
+            if self._exhausted(smtp):
+                self._recycle()
+            else:
+                try:
+                    if (await smtp.noop())[0] == 250:
+                        return smtp
+                except (smtplib.SMTPException, OSError):
+                    pass
+            await AsyncSmtp._quit(smtp)
+        try:
+            return await self._login()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _release(self, smtp):
+        self._idle.append(smtp)
+        self._slots.release()
+
+    async def _discard(self, smtp):
+        await AsyncSmtp._quit(smtp)
+        self._slots.release()
+
+    async def sendmail(self, to_addr, msg):
+        """同 Smtp.sendmail"""
+
+        while True:
+            smtp = await self._acquire()
+            try:
+                await smtp.sendmail(self.sender, to_addr, msg)
+            except smtplib.SMTPRecipientsRefused:
+                self._release(smtp)
+                raise
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException) as e:
+                await self._discard(smtp)
+                if isinstance(e, smtplib.SMTPServerDisconnected) or e.smtp_code == 421:
+                    if smtp.sent > 0:
+                        self._limited(smtp)
+                        continue
+                raise
+            except BaseException:
+                await self._discard(smtp)
+                raise
+            smtp.sent += 1
+            self._release(smtp)
+            return
+
+    async def close(self):
+        """关闭所有空闲的连接"""
+        idle, self._idle = self._idle, []
+        for smtp in idle:
+            await AsyncSmtp._quit(smtp)
+
+
+class RateLimiter:
+    """
+    一个账户的发送速率，账户的所有连接共用，可以在多个线程中同时使用
+    每分钟 per_minute 封、每天 per_day 封两个令牌桶，None 表示不限制；
+    服务器暂时拒绝时暂停这个账户，暂停时间从 retry_wait 开始每次加倍，不超过 max_retry_wait，
+    并在 [一半, 全部] 之间随机，以免多个账户同时重试；额度用完时暂停到第二天
+    """
+
+    def __init__(self, per_minute=None, per_day=None, retry_wait=60, max_retry_wait=3600):
+        now = time.monotonic()
+        # [每秒补充的令牌数, 桶的容量, 当前的令牌数]，开始时是满的
+        self._buckets = [[limit / period, limit, limit]
+                         for limit, period in [(per_minute, 60), (per_day, 24*60*60)] if limit]
+        self._updated = now
+        self._retry_wait = retry_wait
+        self._max_retry_wait = max_retry_wait
+        self._failures = 0          # 连续暂停的次数
+        self._paused_until = now
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_account(cls, account):
+        """
+        按照账户中的 per_minute、per_day、retry_wait 和 max_retry_wait 设置，
+        都没有设置时每个连接每秒一封；兼容以前的 interval (每个连接每封邮件的间隔秒数)
+        """
+        if 'per_minute' in account:
+            per_minute = account['per_minute']
+        else:
+            interval = account.get('interval', 1)
+            per_minute = 60 * account.get('connections', 1) / interval if interval else None
+        return cls(per_minute, account.get('per_day'),
+                   account.get('retry_wait', 60), account.get('max_retry_wait', 3600))
+
+    def _refill(self, now):
+        for bucket in self._buckets:
+            rate, capacity, tokens = bucket
+            bucket[2] = min(capacity, tokens + (now - self._updated) * rate)
+        self._updated = now
+
+    def delay(self):
+        """需要等待的秒数；返回 0 时已经取出了令牌，现在可以发送一封邮件"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = self._paused_until - now
+            for rate, _, tokens in self._buckets:
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+            if wait > 0:
+                return wait
+            for bucket in self._buckets:
+                bucket[2] -= 1
+            return 0
+
+    def succeeded(self):
+        with self._lock:
+            self._failures = 0
+
+    def suspend(self):
+        """服务器暂时拒绝，暂停这个账户，返回暂停的秒数；已经在暂停中时不再加倍"""
+        with self._lock:
+            now = time.monotonic()
+            if self._paused_until > now:
+                return self._paused_until - now
+            wait = min(self._max_retry_wait, self._retry_wait * 2 ** self._failures)
+            wait = random.uniform(wait / 2, wait)
+            self._failures += 1
+            self._paused_until = now + wait
+            return wait
+
+    def retire(self):
+        """这个账户今天的额度用完，暂停到第二天，返回暂停的秒数"""
+        today = datetime.now()
+        tomorrow = (today + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + (tomorrow - today).total_seconds())
+            return self._paused_until - now
 
 
 class Task:
@@ -112,15 +687,27 @@ class Task:
         self._workdir = workdir
         self._email = cfg.email
         self._accounts = cfg.accounts
-        self._receivers = deque(Task._merge_receivers(cfg.address))
+        receivers, self._fields = Task._merge_receivers(cfg.address)
+        self._receivers = deque(receivers)
         self._sent = set()
         self._failed = set()
+        # 只有地址来自 CSV/JSONL 文件 (或者 email['template'] 为 True) 时标题和内容才是模板
         self._message = Message(self._email['from'], self._email['subject'],
                 _parse_and_read(self._email['context']),
-                self._email['attaches'], self._email['reply-to'])
-        self._wait_time = 1*60  # 所有账户都发送失败，然后等待 1 分钟然后再重试
-        self._time_out = 1      # 每封邮件之间发送等待间隔 1 秒钟
+                self._email['attaches'], self._email['reply-to'],
+                template=self._email.get('template', bool(self._fields)))
         self._log_fp = open(os.path.join(workdir, 'log.txt'), 'a')
+        # 所有账户的发送线程共用接收者队列，用 _lock 保护
+        self._lock = threading.Condition()
+        self._sending = set()   # 正在发送的地址
+        self._stop = threading.Event()
+        self._no = 0
+        self._sent_cnt = 0
+        self._failed_cnt = 0
+        # 每个地址的发送结果追加到 progress/journal.txt，每 _compact_every 条合并到进度文件中
+        self._compact_every = 1000
+        self._journal_fp = None
+        self._journaled = 0
 
     @staticmethod
     def load_config(path):
@@ -141,39 +728,27 @@ class Task:
         task.address = addresses
         return task
 
-    def run(self):
-        no = len(self._sent) + len(self._failed) + 1
-        idx = 0
-        suspend_accounts = set()
-        wait_time = self._wait_time
-        sent_cnt = 0
-        failed_cnt = 0
-        force_quit = False
-        while self._receivers and not force_quit:
-            if len(suspend_accounts) == len(self._accounts):
-                suspend_accounts.clear()
-                self.save_progress()        # 保存一下进度
-                self.log("All accounts are suspended, wating {} second then re-try ...".format(wait_time))
-                try:
-                    sleep(wait_time)
-                except (InterruptedError, KeyboardInterrupt):
-                    break
-                wait_time *= 2
-            account = self._accounts[idx]
-            self.log("Using account {} to send emails".format(account['sender']))
-            with closing(Smtp(account)) as smtp:
-                force_quit, cnt, cnt2 = self._send_mail(smtp, no)
-            if cnt + cnt2 == 0:
-                suspend_accounts.add(idx)
-            else:
-                wait_time = self._wait_time
-            sent_cnt += cnt
-            failed_cnt += cnt2
-            no += cnt + cnt2
-            idx = (idx + 1) % len(self._accounts)
+    def run(self, backend='thread'):
+        """
+        发送所有邮件
+        :param backend: 'thread' 每个账户的每个连接一个发送线程；
+                        'asyncio' 每个连接一个协程，所有连接在一个事件循环中发送
+        """
+        self._check_fields()
+        self._no = len(self._sent) + len(self._failed) + 1
+        self._stop.clear()
+        self.save_progress()    # 从当前的进度开始新的日志
+        if backend == 'asyncio':
+            try:
+                asyncio.run(self._send_async())
+            except KeyboardInterrupt:
+                self.log("Interrupted")
+        else:
+            self._send_threads()
 
         self.save_progress()
 
+        sent_cnt, failed_cnt = self._sent_cnt, self._failed_cnt
         rest_total = sent_cnt + failed_cnt + len(self._receivers)  # 本次任务剩下应发送的
         all_cnt = len(self._sent)                  # 所有已发送的
         all_total = all_cnt + len(self._receivers) # 所有应该发送的
@@ -184,22 +759,98 @@ class Task:
 
         self.quit()
 
+    def _send_threads(self):
+        """每个账户的每个连接一个发送线程，同时从共用的队列中取出地址发送"""
+        pools = [Smtp(account) for account in self._accounts]
+        limiters = [RateLimiter.from_account(account) for account in self._accounts]
+        workers = [threading.Thread(target=self._worker, args=(pool, limiter), daemon=True)
+                   for pool, limiter in zip(pools, limiters) for _ in range(pool.connections)]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                while worker.is_alive():
+                    worker.join(0.5)
+        except (InterruptedError, KeyboardInterrupt):
+            self.log("Interrupted, waiting for the emails being sent ...")
+            self._stop.set()
+            with self._lock:
+                self._lock.notify_all()
+            for worker in workers:
+                worker.join()
+        for pool in pools:
+            pool.close()
+
+    async def _send_async(self):
+        """每个账户的每个连接一个协程，同时从共用的队列中取出地址发送"""
+        self._changed = asyncio.Event()     # 有地址发送完或者任务被中断
+        self._stopped = asyncio.Event()     # 任务被中断或者所有地址都发送完了
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGINT, self._interrupt)
+        except (NotImplementedError, RuntimeError):
+            pass    # 不支持时 Ctrl-C 直接结束事件循环，正在发送的地址保存在剩下的接收者中
+        pools = [AsyncSmtp(account) for account in self._accounts]
+        limiters = [RateLimiter.from_account(account) for account in self._accounts]
+        try:
+            await asyncio.gather(*[self._async_worker(pool, limiter)
+                                   for pool, limiter in zip(pools, limiters)
+                                   for _ in range(pool.connections)])
+        finally:
+            for pool in pools:
+                await pool.close()
+            try:
+                loop.remove_signal_handler(signal.SIGINT)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+    def _interrupt(self):
+        self.log("Interrupted, waiting for the emails being sent ...")
+        self._stop.set()
+        self._stopped.set()
+        self._changed.set()
+
 
     def save_progress(self):
         """保存已发送邮件的地址到
         task_dir/progress/{sucess_sent,failed_sent,rest_receivers}.txt
-        文件里
+        文件里，然后清空日志 journal.txt
+
+        每个文件先写入临时文件再替换，任何时候中断，进度文件加上日志都是完整的进度
         """
         progress_path = os.path.join(self._workdir, 'progress')
         os.makedirs(progress_path, exist_ok=True)
         sucess_path = os.path.join(progress_path, 'sucess_sent.txt')
         failed_path = os.path.join(progress_path, 'failed_sent.txt')
         rest_path = os.path.join(progress_path, 'rest_receivers.txt')
-        for file, addrs in [(sucess_path, self._sent),
-                (failed_path, self._failed),
-                (rest_path, self._receivers)]:
-            with open(file, 'w') as fp:
-                fp.write('\n'.join(addrs))
+        journal_path = os.path.join(progress_path, 'journal.txt')
+        with self._lock:
+            # 正在发送的地址还没有结果，也放在剩下的接收者中
+            rest = list(self._sending) + list(self._receivers)
+            for file, addrs in [(sucess_path, self._sent),
+                    (failed_path, self._failed),
+                    (rest_path, rest)]:
+                with open(file + '.tmp', 'w') as fp:
+                    fp.write('\n'.join(addrs))
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                os.replace(file + '.tmp', file)
+            if self._journal_fp is None:
+                self._journal_fp = open(journal_path, 'a')
+            self._journal_fp.truncate(0)
+            os.fsync(self._journal_fp.fileno())
+            self._journaled = 0
+
+    def _journal(self, kind, addr):
+        """在日志中追加一个地址的发送结果并写入磁盘，需要在 _lock 中调用"""
+        if self._journal_fp is None:
+            return
+        self._journal_fp.write('{}\t{}\n'.format(kind, addr))
+        self._journal_fp.flush()
+        os.fsync(self._journal_fp.fileno())
+        self._journaled += 1
+        if self._journaled >= self._compact_every:
+            self.save_progress()
 
     def load_progress(self):
         progress_path = os.path.join(self._workdir, 'progress')
@@ -219,76 +870,309 @@ class Task:
         new_receivers = set(self._receivers)
         rest_receivers = [x for x in Task._read_receivers(rest_path) if x not in new_receivers]
         self._receivers += rest_receivers
+
+        # 重放上次保存进度之后的日志
+        journal_path = os.path.join(progress_path, 'journal.txt')
+        if os.path.isfile(journal_path):
+            with open(journal_path) as fp:
+                for line in fp:
+                    # 中断时没有写完的最后一行忽略
+                    if not line.endswith('\n') or '\t' not in line:
+                        continue
+                    kind, addr = line.rstrip('\n').split('\t', 1)
+                    if kind == 'sent':
+                        self._sent.add(addr)
+                        self._failed.discard(addr)
+                    elif kind == 'failed':
+                        self._failed.add(addr)
         return True
 
     def clear_log(self):
         self._log_fp.truncate(0)
 
     def log(self, *values):
-        print(*values)
-        print(*values, file=self._log_fp)
+        with self._lock:
+            print(*values)
+            print(*values, file=self._log_fp)
 
     def quit(self):
         self._log_fp.close()
+        if self._journal_fp is not None:
+            self._journal_fp.close()
+            self._journal_fp = None
 
 
+    def _check_fields(self):
+        """发送前检查每个要发送的地址都有模板中的变量，不在发送到一半时才出错"""
+        names = self._message.names - {'email'}
+        if not names:
+            return
+        for receiver in self._receivers:
+            if not self._not_sent(receiver):
+                continue
+            missing = names - self._fields.get(receiver, {}).keys()
+            if missing:
+                raise ValueError("{} has no template field {}".format(
+                    receiver, ', '.join(sorted(missing))))
+
     def _not_sent(self, addr):
         return addr not in self._sent and addr not in self._failed
 
 
-    def _send_mail(self, smtp, no):
-        sent_cnt = 0
-        failed_cnt = 0
-        force_quit = False
+    def _take(self):
+        """
+        从共用的队列中取出一个没有发送过的地址，每个地址只交给一个线程
+        队列为空时等待正在发送的邮件的结果（发送失败的地址会放回队列），
+        队列为空并且没有正在发送的邮件，或者任务被中断时返回 None
+        所有地址都发送完时设置 _stop，唤醒还在等待速率限制的线程
+        """
+
+        with self._lock:
+            while not self._stop.is_set():
+                receiver = self._pop()
+                if receiver is not None:
+                    return receiver
+                if not self._sending:
+                    self._stop.set()
+                    return None
+                self._lock.wait()
+            return None
+
+    async def _take_async(self):
+        """_take 的 asyncio 版本，等待时不阻塞事件循环"""
+
+        while not self._stop.is_set():
+            with self._lock:
+                receiver = self._pop()
+                if receiver is not None:
+                    return receiver
+                if not self._sending:
+                    self._stop.set()
+                    self._stopped.set()
+                    return None
+            self._changed.clear()
+            await self._changed.wait()
+        return None
+
+    def _pop(self):
+        """从队列中取出一个没有发送过的地址，标记为正在发送，需要在 _lock 中调用"""
         while self._receivers:
             receiver = self._receivers.popleft()
-            if self._not_sent(receiver):
-                try:
-                    smtp.sendmail(receiver, self._message.to(receiver).as_string())
-                    #raise Exception('for test')
-                except (InterruptedError, KeyboardInterrupt):
-                    self._receivers.appendleft(receiver)
-                    force_quit = True
-                    break
-                except Exception as e:
-                    self.log("{}. {} sent email to {} fail".format(no, smtp.sender, receiver), e)
-                    if isinstance(e, smtplib.SMTPRecipientsRefused) and 'User not found' in e.recipients:
-                        self.log("{}. {} sent email to invalid address {}".format(no, smtp.sender, receiver))
-                        self._failed.add(receiver)
-                        failed_cnt += 1
-                    else:
-                        self._receivers.appendleft(receiver)
-                    break
-                self.log("{}. {} sent email to {}".format(no, smtp.sender, receiver))
-                no += 1
-                sent_cnt += 1
+            if self._not_sent(receiver) and receiver not in self._sending:
+                self._sending.add(receiver)
+                return receiver
+        return None
+
+    def _done(self, receiver, sent=None, failed=None):
+        """
+        记录 receiver 的发送结果，返回日志中的序号
+        sent 和 failed 都不是 True 时把地址放回队列的最前面，由其他账户重试
+        """
+
+        with self._lock:
+            self._sending.discard(receiver)
+            no = self._no
+            if sent:
                 self._sent.add(receiver)
+                self._sent_cnt += 1
+                self._no += 1
+                self._journal('sent', receiver)
+            elif failed:
+                self._failed.add(receiver)
+                self._failed_cnt += 1
+                self._no += 1
+                self._journal('failed', receiver)
+            else:
+                self._receivers.appendleft(receiver)
+            self._lock.notify_all()
+            return no
 
-                try:
-                    # 等待 self._time_out 秒，再发送下一封邮件
-                    sleep(self._time_out)
-                except (InterruptedError, KeyboardInterrupt):
-                    force_quit = True
+    def _worker(self, smtp, limiter):
+        """
+        一个账户的一个发送线程，使用账户的连接池 smtp 发送，
+        按照账户的速率 limiter 发送，账户被暂停时只有这个账户的线程等待
+        """
+
+        while True:
+            delay = limiter.delay()
+            if delay > 0:
+                if self._stop.wait(delay):
                     break
+                continue
+            receiver = self._take()
+            if receiver is None:
+                break
+            address = Task._address(receiver)
+            try:
+                smtp.sendmail(address, self._message.render(address, self._fields.get(receiver)))
+            except Exception as e:
+                if Task._rejected(e):
+                    no = self._done(receiver, failed=True)
+                    self.log("{}. {} sent email to {} rejected".format(no, smtp.sender, receiver), e)
+                    continue
+                no = self._done(receiver)
+                self.log("{}. {} sent email to {} fail".format(no, smtp.sender, receiver), e)
+                self._suspend(smtp.sender, limiter, e)
+                continue
+
+            limiter.succeeded()
+            no = self._done(receiver, sent=True)
+            self.log("{}. {} sent email to {}".format(no, smtp.sender, receiver))
+
+    def _suspend(self, sender, limiter, e):
+        """
+        暂时的失败 (4xx 回复、连接断开、登录失败等) 后暂停账户，额度用完时暂停到第二天；
+        服务器用 5xx 拒绝 MAIL FROM 是这个账户的问题 (发送者地址不属于这个用户等)，
+        也暂停到第二天，地址由其他账户发送
+        永久拒绝这个地址的 5xx 回复由 _rejected 处理，不暂停账户
+        """
+        if Task._over_quota(e):
+            wait_time = limiter.retire()
+            self.log("Account {} is over quota, waiting {:.0f} second until tomorrow ...".format(
+                sender, wait_time))
+        elif Task._sender_refused(e):
+            wait_time = limiter.retire()
+            self.log("Account {} is refused by the server, check the sender and login, "
+                     "waiting {:.0f} second until tomorrow ...".format(sender, wait_time))
+        else:
+            wait_time = limiter.suspend()
+            self.log("Account {} is suspended, waiting {:.0f} second then re-try ...".format(
+                sender, wait_time))
+
+    async def _sleep(self, seconds):
+        """等待 seconds 秒，不阻塞其他协程；任务被中断或者发送完时提前返回 True"""
+        try:
+            await asyncio.wait_for(self._stopped.wait(), seconds)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def _async_worker(self, smtp, limiter):
+        """_worker 的 asyncio 版本，等待速率限制和暂停时其他协程继续发送"""
+
+        while True:
+            delay = limiter.delay()
+            if delay > 0:
+                if await self._sleep(delay):
+                    break
+                continue
+            receiver = await self._take_async()
+            if receiver is None:
+                break
+            address = Task._address(receiver)
+            try:
+                await smtp.sendmail(address, self._message.render(address, self._fields.get(receiver)))
+            except Exception as e:
+                if Task._rejected(e):
+                    no = self._done(receiver, failed=True)
+                    self._changed.set()
+                    self.log("{}. {} sent email to {} rejected".format(no, smtp.sender, receiver), e)
+                    continue
+                no = self._done(receiver)
+                self._changed.set()
+                self.log("{}. {} sent email to {} fail".format(no, smtp.sender, receiver), e)
+                self._suspend(smtp.sender, limiter, e)
+                continue
+
+            limiter.succeeded()
+            no = self._done(receiver, sent=True)
+            self._changed.set()
+            self.log("{}. {} sent email to {}".format(no, smtp.sender, receiver))
 
-        return force_quit, sent_cnt, failed_cnt
 
+    @staticmethod
+    def _invalid_address(e):
+        """服务器用 5xx 永久拒绝了收件人地址 (地址不存在等)"""
+        if not isinstance(e, smtplib.SMTPRecipientsRefused):
+            return False
+        return any(500 <= code < 600 for code, _ in e.recipients.values())
+
+    @staticmethod
+    def _rejected(e):
+        """
+        服务器用 5xx 永久拒绝了这封邮件 (RCPT 或者 DATA 的回复)，并且不是额度用完，
+        换账户重试也不会成功，这个地址记为发送失败；MAIL FROM 的拒绝见 _sender_refused
+        """
+        if Task._invalid_address(e):
+            return True
+        return (isinstance(e, smtplib.SMTPDataError)
+                and 500 <= e.smtp_code < 600 and not Task._over_quota(e))
+
+    @staticmethod
+    def _sender_refused(e):
+        """服务器用 5xx 拒绝了发送者 (MAIL FROM 的回复)，和收件人地址无关"""
+        return isinstance(e, smtplib.SMTPSenderRefused) and 500 <= e.smtp_code < 600
+
+    @staticmethod
+    def _over_quota(e):
+        """
+        服务器因为发送者的额度用完而拒绝 (MAIL 或 DATA 的 5xx 回复，并且说明中有 quota、limit 等)
+        收件人的邮箱满了是拒绝 RCPT (SMTPRecipientsRefused)，邮件太大是说明中有 size，都不是发送者的额度
+        """
+        if not isinstance(e, (smtplib.SMTPSenderRefused, smtplib.SMTPDataError)) or e.smtp_code < 500:
+            return False
+        reply = e.smtp_error.decode('utf-8', 'replace') if isinstance(e.smtp_error, bytes) else str(e.smtp_error)
+        if re.search(r'size|too (big|large)', reply, re.IGNORECASE):
+            return False
+        return re.search(r'quota|limit|exceed|too many', reply, re.IGNORECASE) is not None
 
     @staticmethod
     def _read_receivers(file):
         with open(file) as fp:
             return [addr.strip() for addr in fp.readlines()]
 
+    @staticmethod
+    def _read_rows(file):
+        """
+        读取 CSV (第一行是表头) 或者 JSONL (每行一个对象) 格式的地址文件，每一行必须有 email
+        :return: [(地址, 这一行的所有列作为模板变量), ...]
+        """
+        with open(file, newline='', encoding='utf-8') as fp:
+            if file.endswith('.csv'):
+                rows = csv.DictReader(fp)
+            else:
+                rows = (json.loads(line) for line in fp if line.strip())
+            receivers = []
+            for no, row in enumerate(rows, 1):
+                if not row.get('email'):
+                    raise ValueError("{}: row {} has no email".format(file, no))
+                receivers.append((row['email'].strip(), row))
+            return receivers
+
+    @staticmethod
+    def _address(receiver):
+        """接收者 '地址#n' 的邮件地址 (域名中不会有 #)，普通的接收者就是地址本身"""
+        if '#' in receiver.rpartition('@')[2]:
+            return receiver.rsplit('#', 1)[0]
+        return receiver
+
     @staticmethod
     def _merge_receivers(addresses):
+        """
+        同一个地址在 CSV/JSONL 文件中有多行不同的内容时 (如一个作者的多篇论文)，每一行发送一封邮件：
+        第一行的接收者是地址本身，之后的行依次是 '地址#2'、'地址#3' ...，进度中分别记录；
+        新的行应该添加在文件的最后，内容完全相同的行只发送一次
+        :return: 接收者列表，和 CSV/JSONL 地址文件中每个接收者的模板变量 {接收者: {变量名: 值}}
+        """
         receivers = []
+        fields = {}
+        rows = {}   # 每个地址的所有行 [(接收者, 模板变量), ...]
 
         for addr in addresses:
-            if addr.startswith('@'):
+            if addr.startswith('@') and addr.endswith(('.csv', '.jsonl')):
+                for address, row in Task._read_rows(addr[1:]):
+                    same = rows.setdefault(address, [])
+                    if any(row == other for _, other in same):
+                        continue
+                    receiver = address if not same else '{}#{}'.format(address, len(same) + 1)
+                    same.append((receiver, row))
+                    receivers.append(receiver)
+                    fields[receiver] = row
+            elif addr.startswith('@'):
                 receivers += Task._read_receivers(addr[1:])
             else:
                 receivers.append(addr)
-        return receivers
+        return receivers, fields
 
 
 def args_parser():
@@ -301,6 +1185,10 @@ def args_parser():
             action='store_true',
             default=False,
             help="如果任务保存得有进度，仍然重新开始运行任务 (默认继续运行任务)")
+    parser.add_argument('-b', '--backend',
+            choices=['thread', 'asyncio'],
+            default='thread',
+            help="发送方式：每个连接一个线程 (thread，默认)，或者所有连接在一个 asyncio 事件循环中 (asyncio)")
     return parser.parse_args()
 
 
@@ -315,7 +1203,7 @@ def main():
         ok = task.load_progress()
         if not ok:
             print("Start a new task")
-    task.run()
+    task.run(args.backend)
 
 
 if __name__ == '__main__':